@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+#
+#    EAV-Django is a reusable Django application which implements EAV data model
+#    Copyright © 2009—2010  Andrey Mikhaylenko
+#
+#    This file is part of EAV-Django.
+#
+#    EAV-Django is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    EAV-Django is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with EAV-Django.  If not, see <http://gnu.org/licenses/>.
+"""
+Caching
+~~~~~~~
+
+Schemata are queried constantly but change rarely, so they are cached in
+process memory. Cached data is invalidated by bumping a *generation counter*;
+the counter for schemata is bumped automatically when a schema or a choice is
+saved or deleted (see `eav.models`).
+
+If ``settings.EAV_SHARED_CACHE`` is True, generation counters are also stored
+in the Django cache so that all worker processes notice changes made by any of
+them. Otherwise each process only knows about its own changes. To avoid a cache
+round-trip on every schema lookup, a process reads the shared counters at most
+once per request and at most once per ``settings.EAV_SHARED_CACHE_TTL``
+seconds (1 by default), so changes made by other processes may go unnoticed for
+that long. Changes made by the process itself are noticed immediately.
+
+The counter for attributes (`ATTRS`) is bumped whenever attributes are
+written through EAV-Django. It invalidates data derived from attribute values,
+such as facet choices (see :func:`get_cache_key`). The counter for entities
+(`ENTITIES`) is bumped whenever an entity is saved or deleted; it invalidates
+data that depends on which entities exist, such as facet results.
+
+Note that `QuerySet.update()` does not send any signals; call
+:func:`bump_generation` manually after updating schemata, attributes or
+entities that way.
+"""
+
+# python
+from hashlib import md5
+import time
+
+# django
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import request_started
+try:
+    from django.core.exceptions import EmptyResultSet
+except ImportError:    # Django < 1.11
+    from django.db.models.sql.datastructures import EmptyResultSet
+
+
+__all__ = ['SCHEMATA', 'ATTRS', 'ENTITIES', 'get_generation', 'bump_generation',
+           'get_cache_key', 'get_query_key', 'SchemaRegistry', 'get_schema_registry']
+
+
+SCHEMATA = 'schemata'
+ATTRS = 'attrs'
+ENTITIES = 'entities'
+
+GENERATION_KEY = 'eav:generation:%s'
+DATA_KEY = 'eav:%s:%s'
+
+# local generation counters by namespace
+_generations = {}
+
+# shared generation counters last read from the cache, by namespace:
+# (value, time of reading)
+_shared_generations = {}
+
+# schema registries by entity model
+_registries = {}
+
+
+def _use_shared_cache():
+    return getattr(settings, 'EAV_SHARED_CACHE', False)
+
+
+def _get_shared_generation(namespace):
+    ttl = getattr(settings, 'EAV_SHARED_CACHE_TTL', 1)
+    now = time.time()
+    if namespace in _shared_generations:
+        shared, read_at = _shared_generations[namespace]
+        if 0 <= now - read_at < ttl:
+            return shared
+    key = GENERATION_KEY % namespace
+    shared = cache.get(key)
+    if shared is None:
+        cache.add(key, 1)
+        shared = cache.get(key)
+    _shared_generations[namespace] = shared, now
+    return shared
+
+
+def _forget_shared_generations(**kwargs):
+    _shared_generations.clear()
+
+request_started.connect(_forget_shared_generations,
+                        dispatch_uid='eav_forget_shared_generations')
+
+
+def get_generation(namespace):
+    """
+    Returns current generation of cached data in given namespace. The value
+    is opaque and should only be compared with previously obtained ones.
+    """
+    local = _generations.get(namespace, 0)
+    if not _use_shared_cache():
+        return local
+    return local, _get_shared_generation(namespace)
+
+
+def bump_generation(namespace):
+    "Invalidates all cached data in given namespace."
+    _generations[namespace] = _generations.get(namespace, 0) + 1
+    if _use_shared_cache():
+        key = GENERATION_KEY % namespace
+        try:
+            cache.incr(key)
+        except ValueError:
+            # the key has expired or has never been set
+            cache.set(key, 1)
+        _shared_generations.pop(namespace, None)
+
+
+def get_cache_key(name, parts, namespaces=(SCHEMATA, ATTRS)):
+    """
+    Returns a key for the Django cache built from given name and parts (any
+    objects with stable `repr()`). The key includes current generations of
+    given namespaces, so cached data expires as soon as any of them is
+    bumped. Usage::
+
+        key = get_cache_key('colours', [rubric.pk])
+        colours = cache.get(key)
+        if colours is None:
+            colours = ...
+            cache.set(key, colours)
+    """
+    generations = [get_generation(x) for x in namespaces]
+    digest = md5(repr((list(parts), generations))).hexdigest()
+    return DATA_KEY % (name, digest)
+
+
+def get_query_key(qs):
+    """
+    Returns SQL and params of given queryset to be used as a part of a cache
+    key (see :func:`get_cache_key`). Unlike `str(qs.query)`, works with
+    non-ASCII params and keeps them apart from the SQL. Returns None if the
+    queryset cannot match anything.
+    """
+    try:
+        return qs.query.get_compiler(qs.db).as_sql()
+    except EmptyResultSet:
+        return None
+
+
+class SchemaRegistry(object):
+    """
+    Process-wide cache of schemata (and their choices) available for given
+    entity model. Usage::
+
+        registry = get_schema_registry(ConcreteEntity)
+        registry.schemata             # list of schemata
+        registry.by_name['colour']    # schema named "colour"
+        registry.get_choices(schema)  # list of choices for given schema
+
+    Resolved lookups are cached here, too, as they depend on schemata.
+    """
+    def __init__(self, model):
+        self.model = model
+        self._generation = None
+        self._data = {}
+
+    def _get_data(self):
+        generation = get_generation(SCHEMATA)
+        if generation != self._generation:
+            self._data = {}
+            self._generation = generation
+        return self._data
+
+    @property
+    def schemata(self):
+        data = self._get_data()
+        if 'schemata' not in data:
+            schemata = self.model.get_schemata_for_model().select_related()
+            data['schemata'] = list(schemata)
+        return data['schemata']
+
+    @property
+    def by_name(self):
+        data = self._get_data()
+        if 'by_name' not in data:
+            data['by_name'] = dict((s.name, s) for s in self.schemata)
+        return data['by_name']
+
+    @property
+    def by_id(self):
+        data = self._get_data()
+        if 'by_id' not in data:
+            data['by_id'] = dict((s.pk, s) for s in self.schemata)
+        return data['by_id']
+
+    @property
+    def lookup_plans(self):
+        "Dictionary of resolved lookups (see `BaseEntityQuerySet`)."
+        return self._get_data().setdefault('lookup_plans', {})
+
+    def _get_choices_by_schema(self):
+        data = self._get_data()
+        if 'choices' not in data:
+            choices = dict((s.pk, []) for s in self.schemata)
+            choice_schemata = [s for s in self.schemata
+                               if s.datatype in (s.TYPE_ONE, s.TYPE_MANY)]
+            if choice_schemata:
+                choice_model = choice_schemata[0].choices.model
+                qs = choice_model._default_manager.filter(
+                    schema__in=[s.pk for s in choice_schemata])
+                for choice in qs:
+                    choices[choice.schema_id].append(choice)
+            data['choices'] = choices
+        return data['choices']
+
+    def get_choices(self, schema):
+        "Returns a list of choices for given schema."
+        return self._get_choices_by_schema().get(schema.pk, [])
+
+    def get_choice(self, schema, pk):
+        "Returns choice of given schema by primary key or None."
+        for choice in self.get_choices(schema):
+            if choice.pk == pk:
+                return choice
+
+
+def get_schema_registry(model):
+    "Returns the :class:`SchemaRegistry` for given entity model."
+    try:
+        return _registries[model]
+    except KeyError:
+        return _registries.setdefault(model, SchemaRegistry(model))
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+#
+#    EAV-Django is a reusable Django application which implements EAV data model
+#    Copyright © 2009—2010  Andrey Mikhaylenko
+#
+#    This file is part of EAV-Django.
+#
+#    EAV-Django is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    EAV-Django is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with EAV-Django.  If not, see <http://gnu.org/licenses/>.
+"""
+Exporters
+~~~~~~~~~
+
+Entities are exported with their attributes as CSV or JSON Lines, one column
+per field or schema. The queryset is walked in chunks ordered by primary key;
+attributes of each chunk are fetched with a single query, so memory usage does
+not depend on the number of exported entities.
+
+In CSV, multiple choices are separated with `CHOICE_SEPARATOR` and range
+bounds with `RANGE_SEPARATOR`.
+"""
+
+# python
+import csv
+try:
+    import json
+except ImportError:    # Python < 2.6
+    from django.utils import simplejson as json
+
+# django
+from django.core.serializers.json import DjangoJSONEncoder
+
+# this app
+from caching import get_schema_registry
+
+
+__all__ = ['FORMAT_CSV', 'FORMAT_JSONL', 'export_entities', 'iter_entity_chunks',
+           'iter_entity_rows']
+
+
+FORMAT_CSV = 'csv'
+FORMAT_JSONL = 'jsonl'
+
+CHOICES_AS_TITLES = 'title'
+CHOICES_AS_IDS = 'id'
+
+CHOICE_SEPARATOR = '|'
+RANGE_SEPARATOR = '..'
+
+DEFAULT_CHUNK_SIZE = 1000
+
+
+def iter_entity_chunks(queryset, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yields lists of entities from given queryset ordered by primary key. Each
+    list contains up to `chunk_size` entities with preloaded attributes. Uses
+    keyset pagination, so deep chunks are as cheap as the first one.
+    """
+    queryset = queryset.order_by('pk')
+    last_pk = None
+    while True:
+        qs = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        chunk = list(qs[:chunk_size])
+        if not chunk:
+            return
+        queryset.model.populate_eav(chunk)
+        yield chunk
+        last_pk = chunk[-1].pk
+
+
+def _get_columns(model, fields, names):
+    if fields is None:
+        fields = [f.attname for f in model._meta.fields]
+    schemata = get_schema_registry(model).schemata
+    if names is not None:
+        schemata_by_name = dict((s.name, s) for s in schemata)
+        wrong_names = set(names) - set(schemata_by_name)
+        if wrong_names:
+            raise NameError('Cannot export %s: unknown attribute(s) "%s". '
+                            'Available schemata: (%s).'
+                            % (model._meta.object_name, '", "'.join(wrong_names),
+                               ', '.join(schemata_by_name)))
+        schemata = [schemata_by_name[name] for name in names]
+    return list(fields), schemata
+
+
+def _export_value(schema, value, choices):
+    if value is None:
+        return None
+    if schema.datatype in (schema.TYPE_ONE, schema.TYPE_MANY):
+        items = value if schema.datatype == schema.TYPE_MANY else [value]
+        if choices == CHOICES_AS_IDS:
+            items = [x.pk for x in items]
+        else:
+            items = [x.title for x in items]
+        if schema.datatype == schema.TYPE_ONE:
+            return items[0]
+        return items or None
+    return schema.dump_value(value)
+
+
+def iter_entity_rows(queryset, fields=None, names=None,
+                     choices=CHOICES_AS_TITLES, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yields dictionaries of JSON-serializable values for entities in given
+    queryset. Dates are represented as ISO strings, ranges as lists of two
+    numbers, multiple choices as lists.
+
+    :param fields: list of names of entity fields. Default is all fields.
+    :param names: list of schema names. Default is all schemata available
+        for the model.
+    :param choices: "title" or "id": how choices are represented.
+    """
+    fields, schemata = _get_columns(queryset.model, fields, names)
+    for chunk in iter_entity_chunks(queryset, chunk_size):
+        for entity in chunk:
+            row = dict((name, getattr(entity, name)) for name in fields)
+            for schema in schemata:
+                value = getattr(entity, schema.name)
+                row[schema.name] = _export_value(schema, value, choices)
+            yield row
+
+
+def _format_csv_value(schema, value):
+    if value is None:
+        return ''
+    if schema is None:
+        return unicode(value)
+    if schema.datatype == schema.TYPE_MANY:
+        return CHOICE_SEPARATOR.join(unicode(x) for x in value)
+    if schema.datatype == schema.TYPE_RANGE:
+        return RANGE_SEPARATOR.join('' if x is None else unicode(x)
+                                    for x in value)
+    return unicode(value)
+
+
+def export_entities(queryset, stream, format=FORMAT_CSV, fields=None,
+                    names=None, choices=CHOICES_AS_TITLES,
+                    chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Writes entities from given queryset along with their attributes to given
+    file-like object. Returns the number of exported entities. Usage::
+
+        with open('catalog.csv', 'wb') as f:
+            export_entities(Product.objects.all(), f, names=['colour', 'size'])
+
+    See :func:`iter_entity_rows` for details on parameters.
+    """
+    if format not in (FORMAT_CSV, FORMAT_JSONL):
+        raise ValueError('Unknown export format "%s". Expected "%s" or "%s".'
+                         % (format, FORMAT_CSV, FORMAT_JSONL))
+    fields, schemata = _get_columns(queryset.model, fields, names)
+    rows = iter_entity_rows(queryset, fields, [s.name for s in schemata],
+                            choices, chunk_size)
+    count = 0
+    if format == FORMAT_CSV:
+        columns = [(name, None) for name in fields]
+        columns += [(s.name, s) for s in schemata]
+        writer = csv.writer(stream)
+        writer.writerow([name.encode('utf-8') for name, _ in columns])
+        for row in rows:
+            writer.writerow([_format_csv_value(schema, row[name]).encode('utf-8')
+                             for name, schema in columns])
+            count += 1
+    else:
+        for row in rows:
+            stream.write(json.dumps(row, sort_keys=True, cls=DjangoJSONEncoder) + '\n')
+            count += 1
+    return count
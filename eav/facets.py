@@ -29,21 +29,35 @@ Facets
 from itertools import chain
 
 # django
-from django.db import models
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, models
 from django import forms
 from django.utils.datastructures import SortedDict
+from django.utils.functional import lazy
 from django.utils.translation import ugettext as _
 
 # 3rd-party
 from view_shortcuts.decorators import cached_property
 
 # this app
+from caching import ATTRS, ENTITIES, SCHEMATA, get_cache_key, get_query_key
 from fields import RangeField
+from managers import NULLS_LAST, get_entities_lookups, get_entity_field_name
 
 
 __all__ = ('Facet', 'TextFacet', 'MultiTextFacet', 'ManyToManyFacet',
-           'OneToManyFacet', 'IntegerFacet', 'RangeFacet', 'MultiRangeFacet',
-           'DateFacet', 'BooleanFacet', 'BaseFacetSet')
+           'OneToManyFacet', 'IntegerFacet', 'RangeStatsMixin', 'RangeFacet',
+           'MultiRangeFacet', 'DateFacet', 'BooleanFacet', 'BaseFacetSet')
+
+
+# for how long facet data is kept in the Django cache (None means default
+# timeout); cached data expires anyway once entities, attributes or schemata
+# change
+FACET_CACHE_TIMEOUT = getattr(settings, 'EAV_FACET_CACHE_TIMEOUT', None)
+
+# generation counters by which cached facet data is keyed
+FACET_CACHE_NAMESPACES = (SCHEMATA, ATTRS, ENTITIES)
 
 
 class Facet(object):
@@ -83,7 +97,33 @@ class Facet(object):
         label = unicode(self)
         defaults = dict(required=False, label=label, widget=self.widget)
         defaults.update(self.extra)
-        return self.field_class(**defaults)
+        field = self.field_class(**defaults)
+        if hasattr(field, 'label_from_instance'):
+            # model choice fields: annotate choices with counts
+            field.label_from_instance = lambda obj: self.format_label(unicode(obj), obj.pk)
+        return field
+
+    @property
+    def counts(self):
+        "Returns numbers of items by value (see `BaseFacetSet.counts`)."
+        if not self.schema or not self.facet_set.show_counts:
+            return None
+        return self.facet_set.counts.get(self.schema.name, {})
+
+    def format_label(self, label, value):
+        "Returns choice label annotated with the number of matching items."
+        counts = self.counts
+        if counts is None:
+            return label
+        return u'%s (%d)' % (label, counts.get(value, 0))
+
+    def lazy_label(self, label, value):
+        """
+        Same as :meth:`format_label` but the label is only evaluated when it
+        is rendered. Counts depend on found items and therefore on the form,
+        so they cannot be fetched while the form is being built.
+        """
+        return lazy(self.format_label, unicode)(label, value)
 
     @property
     def attr_name(self):
@@ -118,18 +158,29 @@ class TextFacet(Facet):
         super(TextFacet, self).__init__(*args, **kwargs)
 
     def _get_choices(self, blank=False):
+        # only values present in the base queryset are offered; they are
+        # fetched with a DISTINCT over the attributes of these entities and
+        # cached until entities, attributes or schemata change
+        base_qs = self.facet_set.get_queryset().order_by()
         if self.schema:
-            # FIXME implementation details exposed ###########
-            # FIXME in some cases (e.g. shop) we don't need *all* attrs, it
-            #       would be better to fine-filter them (e.g. by rubric).
-            attrs = self.schema.attrs.all()
+            model = base_qs.model
+            attr_model = model.get_attr_model(self.schema)
+            attrs = attr_model._default_manager.filter(schema=self.schema,
+                **get_entities_lookups(model, base_qs.values_list('pk', flat=True),
+                                       attr_model))
             field_name = 'value_%s' % self.schema.datatype
         else:
-            attrs = self.facet_set.get_queryset()
+            attrs = base_qs
             field_name = self.attr_name
-        choices = set(attrs.values_list(field_name, flat=True).distinct())
+        key = get_cache_key('facet-choices', [self.facet_set.cache_prefix,
+                                              self.attr_name, get_query_key(base_qs)],
+                            FACET_CACHE_NAMESPACES)
+        values = cache.get(key)
+        if values is None:
+            values = sorted(set(attrs.order_by().values_list(field_name, flat=True).distinct()))
+            cache.set(key, values, FACET_CACHE_TIMEOUT)
         blank_choice = [('', _('any'))] if blank else []
-        return blank_choice + [(x,x) for x in choices]
+        return blank_choice + [(x, self.lazy_label(x, x)) for x in values]
 
     @property
     def extra(self):
@@ -199,7 +250,95 @@ class IntegerFacet(Facet):
     field_class = forms.IntegerField
 
 
-class RangeFacet(Facet):
+class RangeStatsMixin(object):
+    """
+    Provides statistics for range facets: minimum and maximum values and
+    a histogram of `bucket_count` equal buckets. Statistics are computed for
+    the facet set's base queryset with a single aggregate query and cached
+    until entities or attributes change. Usage in templates::
+
+        {% for (start, stop), label in facet.bucket_choices %}...{% endfor %}
+    """
+    bucket_count = 5
+
+    def _get_values_queryset(self):
+        # returns a values queryset and the names of columns with lower and
+        # upper bounds (they are equal for plain numbers)
+        base_qs = self.facet_set.get_queryset().order_by()
+        if not self.schema:
+            names = [self.field.name]
+            qs = base_qs
+        else:
+            if self.schema.datatype == self.schema.TYPE_RANGE:
+                names = ['value_range_min', 'value_range_max']
+            else:
+                names = ['value_%s' % self.schema.datatype]
+            model = base_qs.model
+            attr_model = model.get_attr_model(self.schema)
+            qs = attr_model._default_manager.filter(schema=self.schema,
+                **get_entities_lookups(model, base_qs.values_list('pk', flat=True),
+                                       attr_model)).order_by()
+        qs = qs.filter(**{'%s__isnull' % names[0]: False})
+        columns = [qs.model._meta.get_field(x).column for x in names]
+        return qs.values_list(*names), columns[0], columns[-1]
+
+    def _get_stats(self):
+        qs, min_column, max_column = self._get_values_queryset()
+        sql, params = _get_query_sql(qs)
+        qn = connection.ops.quote_name
+        count = self.bucket_count
+        width = '(bounds.hi - bounds.lo) / %d.0' % count
+        columns = ['bounds.lo', 'bounds.hi']
+        low_value, high_value = 'vals.%s' % qn(min_column), 'vals.%s' % qn(max_column)
+        for i in range(count):
+            # an item falls into each bucket its value (or range) overlaps
+            start = 'bounds.lo + %s * %d' % (width, i)
+            if i < count - 1:
+                below_stop = '%s < bounds.lo + %s * %d' % (low_value, width, i + 1)
+            else:
+                below_stop = '%s <= bounds.hi' % low_value
+            columns.append('SUM(CASE WHEN %s >= %s AND %s THEN 1 ELSE 0 END)'
+                           % (high_value, start, below_stop))
+        query = ('SELECT %s FROM (%s) vals, (SELECT MIN(bounds_vals.%s) AS lo, '
+                 'MAX(bounds_vals.%s) AS hi FROM (%s) bounds_vals) bounds '
+                 'GROUP BY bounds.lo, bounds.hi') % (
+            ', '.join(columns), sql, qn(min_column), qn(max_column), sql)
+        cursor = connection.cursor()
+        cursor.execute(query, list(params) + list(params))
+        row = cursor.fetchone()
+        if not row:
+            return {'min': None, 'max': None, 'buckets': []}
+        low, high = row[0], row[1]
+        if low == high:
+            return {'min': low, 'max': high, 'buckets': [(low, high, row[-1])]}
+        step = (high - low) / float(count)
+        stops = [low + step * i for i in range(count)] + [high]
+        buckets = [(stops[i], stops[i + 1], row[2 + i] or 0) for i in range(count)]
+        return {'min': low, 'max': high, 'buckets': buckets}
+
+    @cached_property
+    def stats(self):
+        """
+        Returns a dictionary with keys `min`, `max` and `buckets`, the latter
+        being a list of tuples `(start, stop, number of items)`.
+        """
+        key = get_cache_key('facet-stats', [self.facet_set.cache_prefix,
+            self.attr_name, get_query_key(self.facet_set.get_queryset()),
+            self.bucket_count], FACET_CACHE_NAMESPACES)
+        stats = cache.get(key)
+        if stats is None:
+            stats = self._get_stats()
+            cache.set(key, stats, FACET_CACHE_TIMEOUT)
+        return stats
+
+    @property
+    def bucket_choices(self):
+        "Returns a list of pairs `((start, stop), label)` for the histogram."
+        return [((start, stop), u'%g-%g (%d)' % (start, stop, count))
+                for start, stop, count in self.stats['buckets']]
+
+
+class RangeFacet(RangeStatsMixin, Facet):
     "A simple range facet: two widgets, one attribute value (number)."
     field_class = RangeField
 
@@ -214,7 +353,7 @@ class RangeFacet(Facet):
         return {'%s__range' % self.lookup_name: (start or 0, stop)}
 
 
-class MultiRangeFacet(Facet):
+class MultiRangeFacet(RangeStatsMixin, Facet):
     "A complex range facet: two widgets, two attribute values (numbers)."
     field_class = RangeField
 
@@ -235,6 +374,14 @@ class BooleanFacet(Facet):
     # XXX this is funny but using RadioSelect for booleans is non-trivial
     #widget = RadioSelect
 
+    @property
+    def extra(self):
+        widget = forms.NullBooleanSelect()
+        values = {'2': True, '3': False}
+        widget.choices = [(k, self.lazy_label(label, values[k]) if k in values else label)
+                          for k, label in widget.choices]
+        return {'widget': widget}
+
     def get_lookups(self, value):
         return {self.lookup_name: value} if value is not None else {}
 
@@ -249,11 +396,44 @@ FACET_FOR_DATATYPE_DEFAULTS = {
     'many':  ManyToManyFacet,
 }
 
+# datatypes of schemata whose facets display choices with counts
+COUNTED_DATATYPES = ('text', 'bool', 'one', 'many')
+
 FACET_FOR_FIELD_DEFAULTS = {
     models.FloatField: RangeFacet,
 }
 
 
+def _get_value_field(schema):
+    if schema.datatype in (schema.TYPE_ONE, schema.TYPE_MANY):
+        return 'choice'
+    return 'value_%s' % schema.datatype
+
+
+def _normalize_value(value):
+    if isinstance(value, models.Model):
+        return value.pk
+    if isinstance(value, tuple):
+        # order matters, e.g. in ranges
+        return tuple(_normalize_value(x) for x in value)
+    if isinstance(value, (list, set, models.query.QuerySet)):
+        return sorted(_normalize_value(x) for x in value)
+    return value
+
+
+def _get_query_sql(qs):
+    query = qs.query
+    if hasattr(query, 'get_compiler'):
+        return query.get_compiler(qs.db).as_sql()
+    return query.as_sql()    # Django < 1.2
+
+
+def _get_ids(qs):
+    # extra columns used as sort keys must be selected along with the keys
+    extra = list(qs.query.extra_select)
+    return [row[0] for row in qs.values_list('pk', *extra)]
+
+
 class BaseFacetSet(object):
     """ Base class for facet sets.  Concrete classes must overload at least
     the `get_queryset` attribute.
@@ -262,6 +442,22 @@ class BaseFacetSet(object):
     sortable_fields = []
     custom_facets = {}
 
+    # where to put items that lack the attribute they are sorted by
+    sort_nulls = NULLS_LAST
+
+    # whether facet choices are annotated with numbers of matching items
+    show_counts = True
+
+    # whether ids of found items and facet counts are kept in the Django cache
+    # (keyed by normalized data, see `get_normalized_data`); cached results
+    # expire as soon as any entity, attribute or schema is changed
+    cache_results = False
+
+    # how many ids of found items are cached at most; larger result sets are
+    # queried anew (only their count and facet counts are cached). Keep it
+    # below the limit of query parameters (999 for SQLite)
+    cache_max_ids = 500
+
     def __getitem__(self, k):
         return self.object_list[k]
 
@@ -272,6 +468,8 @@ class BaseFacetSet(object):
         return iter(self.object_list)
 
     def __len__(self):
+        if self.cache_results:
+            return self._results['count']
         if self.object_list:
             return self.object_list.count()
         return 0
@@ -279,6 +477,15 @@ class BaseFacetSet(object):
     def get_queryset(self, **kwargs):
         raise NotImplementedError('BaseFacetSet subclasses must define get_queryset()')
 
+    @property
+    def cache_prefix(self):
+        """
+        Identifies this facet set in cache keys. Data is also keyed by the SQL
+        of `get_queryset()`, so facet sets that differ only by their querysets
+        (e.g. by tenant or rubric) need not override this.
+        """
+        return '%s.%s' % (type(self).__module__, type(self).__name__)
+
     def get_schemata(self):
         return self.get_queryset().model.get_schemata_for_model()
 
@@ -357,24 +564,123 @@ class BaseFacetSet(object):
             lookups.update(facet.get_lookups(value))
         return lookups
 
+    def get_normalized_data(self):
+        """
+        Returns a representation of the search which does not depend on how
+        the data was spelled: cleaned lookups sorted by name, multiple values
+        sorted, model instances replaced by primary keys, and the ordering.
+        Raises ValidationError if the data is invalid.
+        """
+        lookups = sorted((str(k), _normalize_value(v))
+                         for k, v in self.get_lookups().items())
+        order_by = self.data.get('order_by') or None
+        return lookups, order_by, bool(order_by and self.data.get('order_desc'))
+
+    @cached_property
+    def _results(self):
+        try:
+            data = self.get_normalized_data()
+        except forms.ValidationError:
+            return {'ids': [], 'count': 0, 'counts': {}}
+        key = get_cache_key('facet-results', [self.cache_prefix,
+                                              get_query_key(self.get_queryset()),
+                                              data, self.cache_max_ids],
+                            FACET_CACHE_NAMESPACES)
+        results = cache.get(key)
+        if results is None:
+            qs = self._get_object_list()
+            ids = _get_ids(qs[:self.cache_max_ids + 1])
+            if len(ids) > self.cache_max_ids:
+                # too many to cache; only the count is kept
+                ids, count = None, qs.count()
+            else:
+                count = len(ids)
+            results = {
+                'ids': ids,
+                'count': count,
+                'counts': self._get_counts(qs) if self.show_counts else {},
+            }
+            cache.set(key, results, FACET_CACHE_TIMEOUT)
+        return results
+
+    @property
+    def object_ids(self):
+        "Returns the list of primary keys of found items in their order."
+        if self.cache_results and self._results['ids'] is not None:
+            return self._results['ids']
+        return _get_ids(self.object_list)
+
     @cached_property
     def object_list(self):
+        if not self.cache_results or self._results['ids'] is None:
+            return self._get_object_list()
+        ids = self._results['ids']
+        if not ids:
+            return self.get_queryset().none()
+        qs = self.get_queryset().filter(pk__in=ids)
+        order_by_name = self.data.get('order_by')
+        if order_by_name:
+            qs = self.sort_by_attribute(qs, order_by_name)
+        return qs
+
+    def _get_object_list(self):
         try:
             lookups = self.get_lookups()
         except forms.ValidationError:
             return self.get_queryset().none()
         lookups = dict((str(k),v) for k,v in lookups.items())
 
-        # assume to use the EntityManager's smart filter()
-        qs = self.get_queryset(**lookups).distinct()
+        # assume to use the EntityManager's smart filter(); it queries EAV
+        # attributes in subqueries, so the results need not be made distinct
+        qs = self.get_queryset(**lookups)
 
         order_by_name = self.data.get('order_by')
         if order_by_name:
             qs = self.sort_by_attribute(qs, order_by_name)
         return qs
 
+    @cached_property
+    def counts(self):
+        """
+        Returns numbers of items in `object_list` by schema name and value
+        (choice primary key for choice schemata), e.g.::
+
+            {'colour': {u'red': 124, u'green': 3}, 'size': {1: 50, 2: 77}}
 
-    def sort_by_attribute(self, qs, name):
+        All filterable schemata are counted with a single aggregate query over
+        the attributes table grouped by schema and value.
+        """
+        if self.cache_results:
+            return self._results['counts']
+        return self._get_counts(self.object_list)
+
+    def _get_counts(self, object_list):
+        schemata = [s for s in self.filterable_schemata
+                    if s.datatype in COUNTED_DATATYPES]
+        if not schemata:
+            return {}
+        model = self.get_queryset().model
+        value_fields = dict((s.pk, _get_value_field(s)) for s in schemata)
+        entity_ids = object_list.order_by().values_list('pk', flat=True)
+        # one aggregate query per attribute table (see `eav_attr_models`)
+        schemata_by_model = SortedDict()
+        for schema in schemata:
+            attr_model = model.get_attr_model(schema)
+            schemata_by_model.setdefault(attr_model, []).append(schema)
+        counts = dict((s.name, {}) for s in schemata)
+        names = dict((s.pk, s.name) for s in schemata)
+        for attr_model, model_schemata in schemata_by_model.items():
+            attrs = attr_model._default_manager.filter(schema__in=model_schemata,
+                **get_entities_lookups(model, entity_ids, attr_model)).order_by()
+            fields = set(value_fields[s.pk] for s in model_schemata)
+            rows = attrs.values('schema', *fields)
+            rows = rows.annotate(count=models.Count(get_entity_field_name(attr_model)))
+            for row in rows:
+                value = row[value_fields[row['schema']]]
+                counts[names[row['schema']]][value] = row['count']
+        return counts
+
+    def sort_by_attribute(self, qs, *names):
         """
         A wrapper around standard order_by() method. Allows to sort by both normal
         fields and EAV attributes without thinking about implementation details.
@@ -383,20 +689,19 @@ class BaseFacetSet(object):
             qs = sort_by_attributes(qs, 'price', 'colour')
 
         ...where `price` is a FloatField, and `colour` is the name of an EAV attribute
-        represented by Schema and Attr models.
+        represented by Schema and Attr models. Items that lack an attribute are
+        placed according to `sort_nulls`.
         """
         fields   = self.get_queryset().model._meta.get_all_field_names()
         schemata = self.sortable_names
         direction = '-' if self.data.get('order_desc') else ''
-        if name in fields:
-            return qs.order_by('%s%s' % (direction, name))
-        elif name in schemata:
-            schema = self.get_schema(name)
-            value_lookup = 'attrs__value_%s' % schema.datatype
-            order_lookup = '%s%s' % (direction, value_lookup)
-            return qs.filter(attrs__schema__name=name).order_by(order_lookup)
-        else:
-            raise NameError('Cannot order items by attributes: unknown '
-                            'attribute "%s". Available fields: %s. '
-                            'Available schemata: %s.' % (name,
-                            ', '.join(fields), ', '.join(schemata)))
+        for name in names:
+            if name not in fields and name not in schemata:
+                raise NameError('Cannot order items by attributes: unknown '
+                                'attribute "%s". Available fields: %s. '
+                                'Available schemata: %s.' % (name,
+                                ', '.join(fields), ', '.join(schemata)))
+        # assume to use the EntityQuerySet's smart order_by(); attributes are
+        # annotated as sort keys, so rows are not multiplied
+        order_by = ['%s%s' % (direction, name) for name in names]
+        return qs.order_by(*order_by, **{'nulls': self.sort_nulls})
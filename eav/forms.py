@@ -110,15 +110,17 @@ class BaseDynamicEntityForm(ModelForm):
                 'help_text': schema.help_text,
             }
 
+            # all attributes of the instance are loaded with a single query
+            # on first access, then served from its cache
+            value = getattr(self.instance, schema.name)
+
             datatype = schema.datatype
             if datatype == schema.TYPE_MANY:
-                choices = getattr(self.instance, schema.name)
                 defaults.update({'queryset': schema.get_choices(),
-                                 'initial': [x.pk for x in choices]})
+                                 'initial': [x.pk for x in value]})
             elif datatype == schema.TYPE_ONE:
-                choice = getattr(self.instance, schema.name)
                 defaults.update({'queryset': schema.get_choices(),
-                                 'initial': choice.pk if choice else None,
+                                 'initial': value.pk if value else None,
                                  # if schema is required remove --------- from ui
                                  'empty_label' : None if schema.required else u"---------"})
 
@@ -131,7 +133,6 @@ class BaseDynamicEntityForm(ModelForm):
             self.fields[schema.name] = MappedField(**defaults)
 
             # fill initial data (if attribute was already defined)
-            value = getattr(self.instance, schema.name)
             if value and not datatype in (schema.TYPE_ONE, schema.TYPE_MANY):    # choices are already done above
                 self.initial[schema.name] = value
 
@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+#
+#    EAV-Django is a reusable Django application which implements EAV data model
+#    Copyright © 2009—2010  Andrey Mikhaylenko
+#
+#    This file is part of EAV-Django.
+#
+#    EAV-Django is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    EAV-Django is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with EAV-Django.  If not, see <http://gnu.org/licenses/>.
+"""
+Importers
+~~~~~~~~~
+
+Entities are imported from CSV or JSON Lines in the format produced by
+`eav.exporters`. Values are coerced according to schema data types, rows which
+cannot be imported are written to a separate "rejects" file, and valid rows
+are written in chunks with `BaseEntityManager.bulk_create_with_attrs`. Rows
+refused by the database (e.g. violating unique constraints) are rejected as
+well; the rest of the chunk is still imported.
+"""
+
+# python
+import csv
+import datetime
+try:
+    import json
+except ImportError:    # Python < 2.6
+    from django.utils import simplejson as json
+
+# django
+from django.core.exceptions import ValidationError
+from django.db import DatabaseError
+
+# this app
+from caching import get_schema_registry
+from exporters import (CHOICE_SEPARATOR, CHOICES_AS_IDS, CHOICES_AS_TITLES,
+                       FORMAT_CSV, FORMAT_JSONL, RANGE_SEPARATOR)
+from models import validate_range_value
+
+
+__all__ = ['import_entities', 'coerce_value', 'get_choice_map']
+
+
+DEFAULT_CHUNK_SIZE = 1000
+
+ERROR_COLUMN = '_error'
+LINE_COLUMN = '_line'
+
+TRUE_VALUES = ('1', 'true', 'yes', 'on')
+FALSE_VALUES = ('0', 'false', 'no', 'off')
+
+
+def get_choice_map(model, choices=CHOICES_AS_TITLES):
+    """
+    Returns a dictionary of choices keyed by schema primary key and then by
+    choice title (or primary key, depending on `choices`). Choices are taken
+    from the schema registry, i.e. fetched with at most one query.
+    """
+    registry = get_schema_registry(model)
+    if choices == CHOICES_AS_IDS:
+        get_key = lambda choice: choice.pk
+    else:
+        get_key = lambda choice: choice.title
+    choice_map = {}
+    for schema in registry.schemata:
+        schema_choices = registry.get_choices(schema)
+        choice_map[schema.pk] = dict((get_key(x), x) for x in schema_choices)
+    return choice_map
+
+
+def _split(value, separator):
+    if hasattr(value, '__iter__'):
+        return list(value)
+    return [x.strip() for x in value.split(separator)]
+
+
+def coerce_value(schema, value, choice_map, choices=CHOICES_AS_TITLES):
+    """
+    Converts given raw value (a string from CSV or a JSON value) to a value
+    suitable for given schema. Empty values are converted to None. Raises
+    ValueError or TypeError if the value cannot be converted.
+
+    :param choice_map: dictionary returned by :func:`get_choice_map`.
+    """
+    if value is None or value == '' or value == []:
+        return None
+    datatype = schema.datatype
+    if datatype in (schema.TYPE_ONE, schema.TYPE_MANY):
+        items = _split(value, CHOICE_SEPARATOR)
+        if choices == CHOICES_AS_IDS:
+            items = [int(x) for x in items]
+        schema_choices = choice_map.get(schema.pk, {})
+        try:
+            items = [schema_choices[x] for x in items]
+        except KeyError as e:
+            raise ValueError('Unknown choice "%s" for attribute "%s".'
+                             % (e.args[0], schema.name))
+        if datatype == schema.TYPE_ONE:
+            if len(items) > 1:
+                raise ValueError('Attribute "%s" accepts only one choice.'
+                                 % schema.name)
+            return items[0]
+        return items
+    if datatype == schema.TYPE_RANGE:
+        items = _split(value, RANGE_SEPARATOR)
+        value = tuple(None if x in ('', None) else float(x) for x in items)
+        validate_range_value(value)
+        return value
+    if datatype == schema.TYPE_FLOAT:
+        return float(value)
+    if datatype == schema.TYPE_DATE:
+        if isinstance(value, datetime.date):
+            return value
+        return datetime.date(*[int(x) for x in value.split('-')])
+    if datatype == schema.TYPE_BOOLEAN:
+        if isinstance(value, bool):
+            return value
+        if unicode(value).lower() in TRUE_VALUES:
+            return True
+        if unicode(value).lower() in FALSE_VALUES:
+            return False
+        raise ValueError('Expected a boolean value, got "%s".' % value)
+    return unicode(value)
+
+
+def _coerce_field_value(field, value):
+    if value in ('', None):
+        if field.null:
+            return None
+        if not (field.has_default() or field.empty_strings_allowed):
+            raise ValueError('Field "%s" requires a value.' % field.name)
+        return field.get_default()
+    # runs validators as well, e.g. checks max_length
+    return field.clean(value, None)
+
+
+def _read_rows(stream, format):
+    """
+    Yields raw rows: dictionaries of byte strings for CSV, lines for JSON
+    Lines. They are parsed with :func:`_parse_row` so that a malformed row
+    can be rejected without aborting the import.
+    """
+    if format == FORMAT_CSV:
+        for row in csv.DictReader(stream):
+            yield row
+    else:
+        for line in stream:
+            if line.strip():
+                yield line
+
+
+def _decode(value, errors='strict'):
+    if isinstance(value, str):
+        return value.decode('utf-8', errors)
+    return value
+
+
+def _parse_row(raw, format):
+    "Returns a dictionary of values keyed by column. Raises ValueError."
+    if format == FORMAT_CSV:
+        # missing trailing cells are None; extra cells are keyed by None
+        return dict((_decode(k), _decode(v or ''))
+                    for k, v in raw.items() if k is not None)
+    row = json.loads(raw)
+    if not isinstance(row, dict):
+        raise ValueError('Expected a JSON object, got "%s".'
+                         % _decode(raw, 'replace').strip())
+    return row
+
+
+def _get_rejected_row(raw, format):
+    "Returns given unparsable raw row as it should be written to rejects."
+    if format == FORMAT_CSV:
+        return dict((_decode(k, 'replace'), _decode(v or '', 'replace'))
+                    for k, v in raw.items() if k is not None)
+    return {LINE_COLUMN: _decode(raw, 'replace').rstrip('\r\n')}
+
+
+class _RejectWriter(object):
+    def __init__(self, stream, format):
+        self.stream = stream
+        self.format = format
+        self.count = 0
+        self._columns = None
+        self._csv_writer = None
+
+    def write(self, row, error):
+        self.count += 1
+        if self.stream is None:
+            return
+        row = dict(row, **{ERROR_COLUMN: unicode(error)})
+        if self.format == FORMAT_CSV:
+            if self._csv_writer is None:
+                # columns are defined by the first rejected row
+                self._columns = sorted(row.keys())
+                self._csv_writer = csv.writer(self.stream)
+                self._csv_writer.writerow([x.encode('utf-8') for x in self._columns])
+            self._csv_writer.writerow([unicode(row.get(x, '')).encode('utf-8')
+                                       for x in self._columns])
+        else:
+            self.stream.write(json.dumps(row, sort_keys=True))
+            self.stream.write('\n')
+
+
+def import_entities(model, stream, format=FORMAT_CSV, mapping=None,
+                    rejects=None, choices=CHOICES_AS_TITLES,
+                    chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Reads rows from given file-like object and creates an entity of given
+    model for each valid row. Returns a tuple `(imported, rejected)` with
+    numbers of rows. Usage::
+
+        with open('feed.csv') as f, open('rejects.csv', 'wb') as r:
+            import_entities(Product, f, mapping={'Colour': 'colour'}, rejects=r)
+
+    :param mapping: dictionary of field or schema names keyed by column
+        names. Columns which are not in the mapping are expected to be named
+        after fields or schemata. Columns mapped to None are ignored.
+    :param rejects: file-like object for invalid rows (in the same format,
+        with an extra column containing the error message). JSON lines which
+        cannot be parsed are written as is in a separate column.
+    :param choices: "title" or "id": how choices are represented.
+    :param chunk_size: how many rows are written at once (within a single
+        transaction).
+    """
+    if format not in (FORMAT_CSV, FORMAT_JSONL):
+        raise ValueError('Unknown import format "%s". Expected "%s" or "%s".'
+                         % (format, FORMAT_CSV, FORMAT_JSONL))
+    mapping = mapping or {}
+    fields = dict((f.name, f) for f in model._meta.fields)
+    fields.update((f.attname, f) for f in model._meta.fields)
+    schemata = get_schema_registry(model).by_name
+    choice_map = get_choice_map(model, choices)
+    reject_writer = _RejectWriter(rejects, format)
+
+    imported = 0
+    chunk = []
+    for raw in _read_rows(stream, format):
+        try:
+            row = _parse_row(raw, format)
+        except ValueError as e:
+            reject_writer.write(_get_rejected_row(raw, format), e)
+            continue
+        try:
+            kwargs = {}
+            for column, value in row.items():
+                name = mapping.get(column, column)
+                if name is None:
+                    continue
+                if name in fields:
+                    field = fields[name]
+                    kwargs[field.attname] = _coerce_field_value(field, value)
+                elif name in schemata:
+                    kwargs[name] = coerce_value(schemata[name], value,
+                                                choice_map, choices)
+                else:
+                    raise NameError('Unknown attribute "%s".' % name)
+        except (NameError, TypeError, ValueError, ValidationError) as e:
+            reject_writer.write(row, e)
+            continue
+        chunk.append((row, kwargs))
+        if len(chunk) == chunk_size:
+            imported += _write_chunk(model, chunk, reject_writer)
+            chunk = []
+    if chunk:
+        imported += _write_chunk(model, chunk, reject_writer)
+    return imported, reject_writer.count
+
+
+def _write_chunk(model, chunk, reject_writer):
+    """
+    Creates entities from given pairs of raw rows and keyword arguments
+    within a single transaction. If the database refuses the chunk, rows are
+    written one by one and those refused again are rejected. Returns the
+    number of created entities.
+    """
+    manager = model._default_manager
+    try:
+        manager.bulk_create_with_attrs([kwargs for _, kwargs in chunk], len(chunk))
+        return len(chunk)
+    except DatabaseError:
+        pass
+    imported = 0
+    for row, kwargs in chunk:
+        try:
+            manager.bulk_create_with_attrs([kwargs])
+        except DatabaseError as e:
+            reject_writer.write(row, e)
+        else:
+            imported += 1
+    return imported
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+#
+#    EAV-Django is a reusable Django application which implements EAV data model
+#    Copyright © 2009—2010  Andrey Mikhaylenko
+#
+#    This file is part of EAV-Django.
+#
+#    EAV-Django is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    EAV-Django is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with EAV-Django.  If not, see <http://gnu.org/licenses/>.
+"""
+Reports indexes recommended for EAV attribute tables (see
+`eav.models.ATTRIBUTE_INDEXES`) that are missing in the database::
+
+    ./manage.py eav_check_indexes
+    ./manage.py eav_check_indexes shop.Attr --sql
+
+"""
+
+# python
+from optparse import make_option
+
+# django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import get_model, get_models
+from django.db.models.fields import FieldDoesNotExist
+
+# this app
+from eav.managers import get_entity_field_name
+from eav.models import (ATTRIBUTE_INDEXES, RANGE_BUCKET_INDEXES,
+                        BaseRangeBucket, BaseTypedAttribute)
+
+
+def get_expected_indexes(model):
+    "Returns a list of tuples of column names which should be indexed."
+    if issubclass(model, BaseTypedAttribute):
+        # attributes may refer to entities with a foreign key named `entity`
+        entity_field = get_entity_field_name(model)
+        indexes = [tuple(entity_field if x == 'entity_id' else x for x in names)
+                   for names in ATTRIBUTE_INDEXES]
+    elif issubclass(model, BaseRangeBucket):
+        indexes = RANGE_BUCKET_INDEXES
+    else:
+        return []
+    expected = []
+    for names in indexes:
+        try:
+            columns = [model._meta.get_field(x).column for x in names]
+        except FieldDoesNotExist:
+            # the concrete model does not define some of the fields
+            continue
+        expected.append(tuple(columns))
+    return expected
+
+
+def get_existing_indexes(cursor, table):
+    """
+    Returns a list of tuples of column names covered by indexes (including
+    unique and primary key constraints) or None if composite indexes cannot
+    be introspected for the database.
+    """
+    introspection = connection.introspection
+    if hasattr(introspection, 'get_constraints'):    # Django >= 1.6
+        constraints = introspection.get_constraints(cursor, table)
+        return [tuple(x['columns']) for x in constraints.values()
+                if x['index'] or x['unique'] or x['primary_key']]
+    vendor = getattr(connection, 'vendor', None)
+    if vendor == 'sqlite':
+        return _get_sqlite_indexes(cursor, table)
+    if vendor == 'postgresql':
+        return _get_postgresql_indexes(cursor, table)
+    if vendor == 'mysql':
+        return _get_mysql_indexes(cursor, table)
+    return None
+
+
+def _get_sqlite_indexes(cursor, table):
+    qn = connection.ops.quote_name
+    cursor.execute('PRAGMA table_info(%s)' % qn(table))
+    # INTEGER PRIMARY KEY is the rowid and has no index of its own
+    indexes = [(row[1],) for row in cursor.fetchall() if row[5]]
+    cursor.execute('PRAGMA index_list(%s)' % qn(table))
+    for name in [row[1] for row in cursor.fetchall()]:
+        cursor.execute('PRAGMA index_info(%s)' % qn(name))
+        indexes.append(tuple(row[2] for row in sorted(cursor.fetchall())))
+    return indexes
+
+
+def _get_postgresql_indexes(cursor, table):
+    cursor.execute('SELECT attnum, attname FROM pg_attribute '
+                   'WHERE attrelid = %s::regclass AND attnum > 0',
+                   [connection.ops.quote_name(table)])
+    names = dict(cursor.fetchall())
+    cursor.execute('SELECT indkey FROM pg_index WHERE indrelid = %s::regclass',
+                   [connection.ops.quote_name(table)])
+    # indkey is an int2vector of column numbers, e.g. "2 5 3"
+    return [tuple(names.get(int(x)) for x in str(row[0]).split())
+            for row in cursor.fetchall()]
+
+
+def _get_mysql_indexes(cursor, table):
+    cursor.execute('SHOW INDEX FROM %s' % connection.ops.quote_name(table))
+    columns = {}
+    for row in cursor.fetchall():
+        # Key_name, Seq_in_index, Column_name
+        columns.setdefault(row[2], []).append((row[3], row[4]))
+    return [tuple(name for _, name in sorted(x)) for x in columns.values()]
+
+
+def get_missing_indexes(cursor, model):
+    """
+    Returns a list of tuples of column names which should be indexed but are
+    not, or None if the existing indexes cannot be introspected.
+    """
+    expected = get_expected_indexes(model)
+    if not expected:
+        return []
+    existing = get_existing_indexes(cursor, model._meta.db_table)
+    if existing is None:
+        return None
+    # an index also serves queries on its leading columns
+    return [columns for columns in expected
+            if not any(x[:len(columns)] == columns for x in existing)]
+
+
+def get_index_sql(table, columns):
+    qn = connection.ops.quote_name
+    name = '%s_%s' % (table, '_'.join(columns))
+    name = name[:connection.ops.max_name_length() or len(name)]
+    return 'CREATE INDEX %s ON %s (%s);' % (qn(name), qn(table),
+                                            ', '.join(qn(x) for x in columns))
+
+
+class Command(BaseCommand):
+    help = 'Reports indexes missing on EAV attribute tables.'
+    args = '[app_label.ModelName ...]'
+    option_list = BaseCommand.option_list + (
+        make_option('--sql', action='store_true', default=False,
+                    help='Print CREATE INDEX statements for missing indexes.'),
+    )
+
+    def handle(self, *model_labels, **options):
+        if model_labels:
+            models = []
+            for label in model_labels:
+                if '.' not in label:
+                    raise CommandError('Expected model label as "app_label.ModelName".')
+                model = get_model(*label.split('.', 1))
+                if model is None:
+                    raise CommandError('Unknown model "%s".' % label)
+                models.append(model)
+        else:
+            models = [x for x in get_models()
+                      if issubclass(x, (BaseTypedAttribute, BaseRangeBucket))]
+
+        cursor = connection.cursor()
+        missing_count = 0
+        for model in models:
+            table = model._meta.db_table
+            missing = get_missing_indexes(cursor, model)
+            if missing is None:
+                self.stderr.write('Composite indexes on %s cannot be introspected '
+                                 'for this database; skipped.\n' % table)
+                continue
+            for columns in missing:
+                missing_count += 1
+                if options['sql']:
+                    self.stdout.write(get_index_sql(table, columns) + '\n')
+                else:
+                    self.stdout.write('%s.%s: missing index on %s (%s)\n' % (
+                        model._meta.app_label, model._meta.object_name,
+                        table, ', '.join(columns)))
+        self.stderr.write('%d missing index(es) found.\n' % missing_count)
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+#
+#    EAV-Django is a reusable Django application which implements EAV data model
+#    Copyright © 2009—2010  Andrey Mikhaylenko
+#
+#    This file is part of EAV-Django.
+#
+#    EAV-Django is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    EAV-Django is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with EAV-Django.  If not, see <http://gnu.org/licenses/>.
+"""
+Exports entities of given model along with their EAV attributes::
+
+    ./manage.py eav_export shop.Product --format=jsonl > products.jsonl
+
+"""
+
+# python
+from optparse import make_option
+
+# django
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model
+
+# this app
+from eav.exporters import (CHOICES_AS_IDS, CHOICES_AS_TITLES, DEFAULT_CHUNK_SIZE,
+                           FORMAT_CSV, FORMAT_JSONL, export_entities)
+
+
+class Command(BaseCommand):
+    help = 'Exports entities of given model with their attributes as CSV or JSON Lines.'
+    args = '<app_label.ModelName>'
+    option_list = BaseCommand.option_list + (
+        make_option('--format', default=FORMAT_CSV,
+                    choices=[FORMAT_CSV, FORMAT_JSONL],
+                    help='Output format: "%s" (default) or "%s".'
+                         % (FORMAT_CSV, FORMAT_JSONL)),
+        make_option('--choices', default=CHOICES_AS_TITLES,
+                    choices=[CHOICES_AS_TITLES, CHOICES_AS_IDS],
+                    help='Represent choices by "%s" (default) or "%s".'
+                         % (CHOICES_AS_TITLES, CHOICES_AS_IDS)),
+        make_option('--fields', default=None,
+                    help='Comma-separated names of fields. Default is all.'),
+        make_option('--names', default=None,
+                    help='Comma-separated names of schemata. Default is all.'),
+        make_option('--chunk-size', type='int', default=DEFAULT_CHUNK_SIZE,
+                    dest='chunk_size',
+                    help='Number of entities fetched at once.'),
+        make_option('--output', '-o', default=None,
+                    help='Output file. Default is stdout.'),
+    )
+
+    def handle(self, model_label=None, **options):
+        if not model_label or '.' not in model_label:
+            raise CommandError('Expected model label as "app_label.ModelName".')
+        model = get_model(*model_label.split('.', 1))
+        if model is None:
+            raise CommandError('Unknown model "%s".' % model_label)
+        if not hasattr(model, 'populate_eav'):
+            raise CommandError('Model "%s" is not an EAV entity.' % model_label)
+
+        split = lambda x: x.split(',') if x else None
+        stream = open(options['output'], 'wb') if options['output'] else self.stdout
+        try:
+            count = export_entities(model._default_manager.all(), stream,
+                                    format=options['format'],
+                                    fields=split(options['fields']),
+                                    names=split(options['names']),
+                                    choices=options['choices'],
+                                    chunk_size=options['chunk_size'])
+        finally:
+            if stream is not self.stdout:
+                stream.close()
+        self.stderr.write('Exported %d entities.\n' % count)
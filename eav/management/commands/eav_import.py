@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+#
+#    EAV-Django is a reusable Django application which implements EAV data model
+#    Copyright © 2009—2010  Andrey Mikhaylenko
+#
+#    This file is part of EAV-Django.
+#
+#    EAV-Django is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    EAV-Django is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with EAV-Django.  If not, see <http://gnu.org/licenses/>.
+"""
+Imports entities of given model along with their EAV attributes::
+
+    ./manage.py eav_import shop.Product products.csv --rejects=rejects.csv
+
+"""
+
+# python
+from optparse import make_option
+import sys
+
+# django
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model
+
+# this app
+from eav.exporters import (CHOICES_AS_IDS, CHOICES_AS_TITLES, FORMAT_CSV,
+                           FORMAT_JSONL)
+from eav.importers import DEFAULT_CHUNK_SIZE, import_entities
+
+
+class Command(BaseCommand):
+    help = 'Imports entities of given model with their attributes from CSV or JSON Lines.'
+    args = '<app_label.ModelName> <filename>'
+    option_list = BaseCommand.option_list + (
+        make_option('--format', default=FORMAT_CSV,
+                    choices=[FORMAT_CSV, FORMAT_JSONL],
+                    help='Input format: "%s" (default) or "%s".'
+                         % (FORMAT_CSV, FORMAT_JSONL)),
+        make_option('--choices', default=CHOICES_AS_TITLES,
+                    choices=[CHOICES_AS_TITLES, CHOICES_AS_IDS],
+                    help='Choices are given by "%s" (default) or "%s".'
+                         % (CHOICES_AS_TITLES, CHOICES_AS_IDS)),
+        make_option('--map', default=None, dest='mapping',
+                    help='Comma-separated column mapping, e.g. '
+                         '"Colour:colour,Notes:" (empty name skips a column).'),
+        make_option('--chunk-size', type='int', default=DEFAULT_CHUNK_SIZE,
+                    dest='chunk_size',
+                    help='Number of rows written at once.'),
+        make_option('--rejects', default=None,
+                    help='File for rows which could not be imported.'),
+    )
+
+    def handle(self, model_label=None, filename=None, **options):
+        if not model_label or '.' not in model_label or not filename:
+            raise CommandError('Expected model label as "app_label.ModelName" '
+                               'and file name.')
+        model = get_model(*model_label.split('.', 1))
+        if model is None:
+            raise CommandError('Unknown model "%s".' % model_label)
+        if not hasattr(model, 'populate_eav'):
+            raise CommandError('Model "%s" is not an EAV entity.' % model_label)
+
+        mapping = {}
+        if options['mapping']:
+            for pair in options['mapping'].split(','):
+                column, _, name = pair.partition(':')
+                mapping[column] = name or None
+
+        stream = sys.stdin if filename == '-' else open(filename, 'rb')
+        rejects = open(options['rejects'], 'wb') if options['rejects'] else None
+        try:
+            imported, rejected = import_entities(model, stream,
+                                                 format=options['format'],
+                                                 mapping=mapping,
+                                                 rejects=rejects,
+                                                 choices=options['choices'],
+                                                 chunk_size=options['chunk_size'])
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+            if rejects:
+                rejects.close()
+        self.stderr.write('Imported %d entities, rejected %d rows.\n'
+                         % (imported, rejected))
@@ -24,22 +24,286 @@ Object Managers
 
 # TODO: .filter(size__isnull=True) --> .exclude(attrs__schema='size')
 
-from django.db.models import Manager
+# python
+import copy
+import datetime
+from functools import wraps
+from itertools import islice
+
+# django
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, transaction
+from django.db.models import AutoField, Manager, Model, Q
+from django.db.models.query import QuerySet, ValuesQuerySet
+from django.db.models.sql import InsertQuery
+from django.utils.datastructures import SortedDict
+
+# this app
+from caching import ATTRS, ENTITIES, bump_generation, get_schema_registry
 
 
 RANGE_INTERSECTION_LOOKUP = 'overlaps'
+RANGE_CONTAINS_LOOKUP = 'contains'
+RANGE_WITHIN_LOOKUP = 'within'
 
+# conditions on lower and upper bounds of stored ranges for each lookup
+RANGE_LOOKUPS = {
+    RANGE_INTERSECTION_LOOKUP: ('value_range_max__gte', 'value_range_min__lte'),
+    RANGE_CONTAINS_LOOKUP: ('value_range_min__lte', 'value_range_max__gte'),
+    RANGE_WITHIN_LOOKUP: ('value_range_min__gte', 'value_range_max__lte'),
+}
 
-class BaseEntityManager(Manager):
+# how many entities are fetched from the cursor before their attributes are
+# loaded with a single query (see BaseEntityQuerySet.prefetch_eav)
+EAV_PREFETCH_CHUNK_SIZE = 100
 
-    # TODO: refactor filter() and exclude()   -- see django.db.models.manager and ...query
+# how many entities are created at once by bulk_create_with_attrs()
+EAV_BULK_BATCH_SIZE = 1000
 
-    def exclude(self, *args, **kw):
-        qs = self.get_query_set().exclude(*args)
-        for lookup, value in kw.items():
-            lookups = self._filter_by_lookup(qs, lookup, value)
-            qs = qs.exclude(**lookups)
-        return qs
+# name of the extra select column used to sort entities by given attribute
+EAV_ORDERING_ALIAS = 'eav_ordering_%s'
+
+# where to put entities that lack the attribute when sorting by it
+NULLS_FIRST = 'first'
+NULLS_LAST = 'last'
+
+
+if hasattr(transaction, 'atomic'):
+    atomic = transaction.atomic
+else:    # Django < 1.6
+    def atomic(func):
+        """
+        Runs given function within a transaction. Unlike `commit_on_success`,
+        does nothing if the caller already manages a transaction: it is
+        neither committed nor split into several ones.
+        """
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if transaction.is_managed():
+                return func(*args, **kwargs)
+            return transaction.commit_on_success(func)(*args, **kwargs)
+        return wrapper
+
+
+def get_entity_field_name(attr_model):
+    """
+    Returns the name of the field by which given attribute model refers to
+    entities: `entity_id` for generic attributes, `entity` for attributes
+    with a foreign key (see `BaseEntityAttribute`). In both cases the raw
+    value is available as `attr.entity_id`.
+    """
+    if is_generic_attr_model(attr_model):
+        return 'entity_id'
+    return 'entity'
+
+
+def is_generic_attr_model(attr_model):
+    "Returns True if given attribute model refers to entities via content type."
+    return 'entity_type' in [f.name for f in attr_model._meta.fields]
+
+
+def get_entity_type_lookups(model, attr_model):
+    """
+    Returns lookups which restrict given attribute model to attributes of
+    given entity model. Attributes with a foreign key to the entity model
+    need no such lookups.
+    """
+    if is_generic_attr_model(attr_model):
+        return {'entity_type': ContentType.objects.get_for_model(model)}
+    return {}
+
+
+def get_entities_lookups(model, pks, attr_model):
+    """
+    Returns lookups which select attributes of given model that belong to
+    entities of given model with given primary keys (a list or a subquery).
+    """
+    lookups = get_entity_type_lookups(model, attr_model)
+    lookups['%s__in' % get_entity_field_name(attr_model)] = pks
+    return lookups
+
+
+def get_attr_value_sql(model, schema, field_name):
+    """
+    Returns SQL and params for a correlated subquery which selects given
+    field of the attribute of given schema for each entity of given model.
+    The subquery can be used as an extra select or in an extra where clause
+    of an entity query. Expects no more than one attribute per entity and
+    schema, i.e. TYPE_MANY is not supported.
+    """
+    attr_model = model.get_attr_model(schema)
+    qn = connection.ops.quote_name
+    entity_field = attr_model._meta.get_field(get_entity_field_name(attr_model))
+    sql = ('SELECT %(attrs)s.%(value)s FROM %(attrs)s'
+           ' WHERE %(attrs)s.%(entity_id)s = %(entities)s.%(pk)s'
+           ' AND %(attrs)s.%(schema)s = %%s') % {
+        'attrs': qn(attr_model._meta.db_table),
+        'entities': qn(model._meta.db_table),
+        'pk': qn(model._meta.pk.column),
+        'value': qn(attr_model._meta.get_field(field_name).column),
+        'entity_id': qn(entity_field.column),
+        'schema': qn(attr_model._meta.get_field('schema').column),
+    }
+    params = [schema.pk]
+    if is_generic_attr_model(attr_model):
+        sql += ' AND %s.%s = %%s' % (
+            qn(attr_model._meta.db_table),
+            qn(attr_model._meta.get_field('entity_type').column))
+        params.append(ContentType.objects.get_for_model(model).pk)
+    return sql, params
+
+
+def _to_date(value):
+    # some backends (e.g. SQLite) return dates in extra selects as strings
+    if isinstance(value, basestring):
+        return datetime.date(*[int(x) for x in value[:10].split('-')])
+    return value
+
+
+EXTRA_VALUE_CONVERTERS = {
+    'float': float,
+    'date': _to_date,
+    'bool': bool,
+}
+
+
+class EavValuesQuerySet(ValuesQuerySet):
+    """
+    A ValuesQuerySet which converts raw values of EAV attributes selected by
+    :meth:`BaseEntityQuerySet.values_eav`.
+    """
+    _eav_converters = {}
+    _eav_ranges = ()
+
+    def _clone(self, *args, **kwargs):
+        kwargs.setdefault('_eav_converters', self._eav_converters)
+        kwargs.setdefault('_eav_ranges', self._eav_ranges)
+        return super(EavValuesQuerySet, self)._clone(*args, **kwargs)
+
+    def iterator(self):
+        for row in super(EavValuesQuerySet, self).iterator():
+            for name in self._eav_ranges:
+                bounds = row.pop('%s__min' % name), row.pop('%s__max' % name)
+                row[name] = None if bounds == (None, None) else bounds
+            for name, convert in self._eav_converters.items():
+                if row.get(name) is not None:
+                    row[name] = convert(row[name])
+            yield row
+
+
+class LookupPlan(object):
+    """
+    A resolved lookup. Tells whether the lookup refers to an ordinary field,
+    to an EAV attribute of the entity or to an EAV attribute of a related
+    entity, and which attribute field and sublookup are used to query it.
+    Plans do not depend on lookup values and are cached by
+    :class:`~eav.caching.SchemaRegistry`.
+    """
+    FIELD = 'field'
+    ATTR = 'attr'
+    RELATED_ATTR = 'related_attr'
+
+    def __init__(self, kind, lookup, schema=None, sublookup=None, model=None,
+                 prefix=None):
+        self.kind = kind
+        self.lookup = lookup
+        self.schema = schema
+        self.sublookup = sublookup
+        self.model = model
+        self.prefix = prefix
+
+    def __repr__(self):
+        return '<LookupPlan %s: %s>' % (self.kind, self.lookup)
+
+    @property
+    def value_field(self):
+        "Name of the attribute field which stores values for the schema."
+        if self.schema is None:
+            return None
+        if self.schema.datatype in (self.schema.TYPE_ONE, self.schema.TYPE_MANY):
+            return 'choice'
+        if self.schema.datatype == self.schema.TYPE_RANGE:
+            return 'value_range_min', 'value_range_max'
+        return 'value_%s' % self.schema.datatype
+
+
+class BaseEntityQuerySet(QuerySet):
+    """
+    QuerySet for entities. Resolves EAV attribute names in `filter()`,
+    `exclude()`, `order_by()` and `values()` and adds some EAV-specific
+    methods to the standard API.
+    """
+    _prefetch_eav = False
+
+    def _clone(self, *args, **kwargs):
+        kwargs.setdefault('_prefetch_eav', self._prefetch_eav)
+        return super(BaseEntityQuerySet, self)._clone(*args, **kwargs)
+
+    def prefetch_eav(self):
+        """
+        Returns a clone of this queryset which loads EAV attributes for all
+        fetched entities in bulk (one query per %d entities) instead of one
+        query per attribute per entity. Usage::
+
+            for entity in ConcreteEntity.objects.filter(rubric=1).prefetch_eav():
+                print entity.colour    # no query here
+        """
+        clone = self._clone()
+        clone._prefetch_eav = True
+        return clone
+    prefetch_eav.__doc__ = prefetch_eav.__doc__ % EAV_PREFETCH_CHUNK_SIZE
+
+    def values_eav(self, *names):
+        """
+        Returns a ValuesQuerySet with given fields and EAV attributes as
+        columns, one row per entity. Attributes are selected by correlated
+        subqueries, so no joins are added and no Attr instances are created.
+        Usage::
+
+            ConcreteEntity.objects.values_eav('title', 'colour', 'age')
+
+        Choices (TYPE_ONE) are represented by primary keys, ranges by tuples.
+        TYPE_MANY is not supported; see :meth:`prefetch_eav`.
+        """
+        schemata = get_schema_registry(self.model).by_name
+        field_names = self.model._meta.get_all_field_names() + ['pk']
+        fields = []
+        select = SortedDict()
+        select_params = []
+        converters = {}
+        ranges = []
+        for name in names:
+            if name in schemata:
+                schema = schemata[name]
+                if schema.datatype == schema.TYPE_MANY:
+                    raise TypeError('Cannot select attribute "%s" as a column:'
+                                    ' multiple choices are not supported.'
+                                    % name)
+                if schema.datatype == schema.TYPE_RANGE:
+                    columns = [('%s__%s' % (name, x), 'value_range_%s' % x)
+                               for x in ('min', 'max')]
+                    ranges.append(name)
+                elif schema.datatype == schema.TYPE_ONE:
+                    columns = [(name, 'choice')]
+                else:
+                    columns = [(name, 'value_%s' % schema.datatype)]
+                    if schema.datatype in EXTRA_VALUE_CONVERTERS:
+                        converters[name] = EXTRA_VALUE_CONVERTERS[schema.datatype]
+                for alias, field_name in columns:
+                    sql, params = get_attr_value_sql(self.model, schema, field_name)
+                    select[alias] = sql
+                    select_params.extend(params)
+            elif name in field_names:
+                fields.append(name)
+            else:
+                raise NameError('Cannot select values: unknown attribute "%s".'
+                                ' Available fields: %s. Available schemata: %s.'
+                                % (name, ', '.join(field_names),
+                                   ', '.join(schemata)))
+        qs = self.extra(select=select, select_params=select_params)
+        return qs._clone(klass=EavValuesQuerySet, setup=True,
+                         _fields=fields + select.keys(),
+                         _eav_converters=converters, _eav_ranges=ranges)
 
     def filter(self, *args, **kw):
         """
@@ -50,21 +314,182 @@ class BaseEntityManager(Manager):
             ConcreteEntity.objects.filter(rubric=1, price=2, colour='green')
 
         ...where `rubric` is a ForeignKey field, and `colour` is the name of an
-        EAV attribute represented by Schema and Attr models.
+        EAV attribute represented by Schema and Attr models. EAV names are
+        resolved at any point of the chain, so the query can be built
+        incrementally::
+
+            qs = ConcreteEntity.objects.filter(colour='green')
+            qs = qs.filter(size=small).exclude(rubric=1)
+
+        EAV names are also resolved in `Q` objects, so conditions can be
+        combined with OR and NOT in a single query::
+
+            qs.filter(Q(colour='green') | ~Q(size=small))
         """
+        qs = super(BaseEntityQuerySet, self).filter(*self._resolve_args(args))
+        for lookup, value in kw.items():
+            lookups = self._filter_by_lookup(qs, lookup, value)
+            qs = super(BaseEntityQuerySet, qs).filter(**lookups)
+        return qs
 
-        qs = self.get_query_set().filter(*args)
+    def exclude(self, *args, **kw):
+        """
+        A wrapper around standard exclude() method, see :meth:`filter`. Note
+        that each keyword argument is excluded separately, i.e. the query
+        excludes objects that match *any* of given conditions.
+        """
+        qs = super(BaseEntityQuerySet, self).exclude(*self._resolve_args(args))
         for lookup, value in kw.items():
             lookups = self._filter_by_lookup(qs, lookup, value)
-            qs = qs.filter(**lookups)
+            qs = super(BaseEntityQuerySet, qs).exclude(**lookups)
         return qs
 
+    def _resolve_args(self, args):
+        return [self._resolve_q(x) if isinstance(x, Q) else x for x in args]
+
+    def _resolve_q(self, q):
+        """
+        Returns a copy of given `Q` object with EAV lookups replaced by
+        subqueries (see :meth:`_filter_by_attrs`). Nested nodes are resolved
+        recursively, their connectors and negation are kept intact.
+        """
+        clone = copy.copy(q)
+        clone.children = []
+        for child in q.children:
+            if isinstance(child, tuple):
+                lookup, value = child
+                lookups = self._filter_by_lookup(self, lookup, value)
+                clone.children.extend(lookups.items())
+            elif isinstance(child, Q):
+                clone.children.append(self._resolve_q(child))
+            else:
+                clone.children.append(child)
+        return clone
+
+    def order_by(self, *field_names, **kwargs):
+        """
+        A wrapper around standard order_by() method. Allows to sort by both
+        normal fields and EAV attributes, any number of them at once::
+
+            ConcreteEntity.objects.order_by('-colour', 'price', nulls=NULLS_LAST)
+
+        Each attribute is an annotated sort key: its value is selected with a
+        correlated subquery, so entities that lack the attribute are kept and
+        no joins are added. Choices (TYPE_ONE) are sorted by primary key,
+        ranges by lower bound; TYPE_MANY is not supported.
+
+        :param nulls: `NULLS_FIRST` or `NULLS_LAST`: where to put entities
+            that lack the attribute. Default is the database default.
+        """
+        nulls = kwargs.pop('nulls', None)
+        if kwargs:
+            raise TypeError('Unexpected keyword argument(s) for order_by(): %s'
+                            % ', '.join(kwargs))
+        if nulls not in (None, NULLS_FIRST, NULLS_LAST):
+            raise ValueError('Expected "%s" or "%s" for `nulls`, got "%s".'
+                             % (NULLS_FIRST, NULLS_LAST, nulls))
+        schemata = get_schema_registry(self.model).by_name
+        select = SortedDict()
+        select_params = []
+        ordering = []
+        for name in field_names:
+            direction, bare_name = ('-', name[1:]) if name.startswith('-') else ('', name)
+            if bare_name not in schemata:
+                ordering.append(name)
+                continue
+            alias = EAV_ORDERING_ALIAS % bare_name
+            sql, params = self.get_sort_key_sql(bare_name)
+            if nulls:
+                # sort by presence of the value first; this works the same
+                # way on all backends unlike NULLS FIRST/LAST in ORDER BY
+                select[alias + '_isnull'] = '(%s) IS NULL' % sql
+                select_params.extend(params)
+                ordering.append('%s%s_isnull' % ('-' if nulls == NULLS_FIRST else '', alias))
+            select[alias] = sql
+            select_params.extend(params)
+            ordering.append(direction + alias)
+        qs = self
+        if select:
+            qs = qs.extra(select=select, select_params=select_params)
+        return super(BaseEntityQuerySet, qs).order_by(*ordering)
+
+    def get_sort_key_sql(self, name):
+        """
+        Returns SQL and params of the expression by which entities are sorted
+        when ordered by given attribute or local field (see :meth:`order_by`).
+        """
+        schemata = get_schema_registry(self.model).by_name
+        if name in schemata:
+            schema = schemata[name]
+            if schema.datatype == schema.TYPE_MANY:
+                raise TypeError('Cannot order items by attribute "%s": '
+                                'multiple choices are not supported.' % name)
+            value_field = self._get_lookup_plan(name).value_field
+            if schema.datatype == schema.TYPE_RANGE:
+                value_field = value_field[0]
+            return get_attr_value_sql(self.model, schema, value_field)
+        if name == 'pk':
+            field = self.model._meta.pk
+        else:
+            field = self.model._meta.get_field(name)
+        qn = connection.ops.quote_name
+        return '%s.%s' % (qn(self.model._meta.db_table), qn(field.column)), []
+
+    def values(self, *fields):
+        """
+        A wrapper around standard values() method. If any of given names
+        refers to an EAV attribute, :meth:`values_eav` is used.
+        """
+        schemata = get_schema_registry(self.model).by_name
+        if any(name in schemata for name in fields):
+            return self.values_eav(*fields)
+        return super(BaseEntityQuerySet, self).values(*fields)
+
     def _filter_by_lookup(self, qs, lookup, value):
+        if self._is_query_name(qs, lookup.split('__', 1)[0]):
+            return {lookup: value}
+        plan = self._get_lookup_plan(lookup)
+        if plan.kind == plan.FIELD:
+            return {lookup: value}
+        schema = plan.schema
+        if schema.datatype in (schema.TYPE_ONE, schema.TYPE_MANY):
+            d = self._filter_by_choice_schema(qs, schema.name, plan.sublookup, value, schema, model=plan.model)
+        elif schema.datatype == schema.TYPE_RANGE:
+            d = self._filter_by_range_schema(qs, schema.name, plan.sublookup, value, schema, model=plan.model)
+        else:
+            d = self._filter_by_simple_schema(qs, schema.name, plan.sublookup, value, schema, model=plan.model)
+        if plan.kind == plan.RELATED_ATTR:
+            return dict(('%s__%s' % (plan.prefix, k), v) for k, v in d.items())
+        return d
+
+    def _is_query_name(self, qs, name):
+        """
+        Returns True if given name refers to an annotation or an extra select
+        of given queryset. Such names are not resolved (and not cached) as
+        they only exist in particular queries.
+        """
+        annotations = getattr(qs.query, 'annotations', None)
+        if annotations is None:    # Django < 1.8
+            annotations = qs.query.aggregates
+        return name in annotations or name in qs.query.extra
+
+    def _get_lookup_plan(self, lookup):
+        """
+        Returns a :class:`LookupPlan` for given lookup. Plans are cached along
+        with schemata, so resolving a lookup normally costs no queries.
+        """
+        plans = get_schema_registry(self.model).lookup_plans
+        try:
+            return plans[lookup]
+        except KeyError:
+            return plans.setdefault(lookup, self._resolve_lookup(lookup))
+
+    def _resolve_lookup(self, lookup):
 
         # TODO: refactor (make recursive resolving of sublookups)
 
         fields   = self.model._meta.get_all_field_names()
-        schemata = dict((s.name, s) for s in self.model.get_schemata_for_model())
+        schemata = get_schema_registry(self.model).by_name
 
         if '__' in lookup:
             name, sublookup = lookup.split('__', 1)
@@ -82,80 +507,81 @@ class BaseEntityManager(Manager):
             else:
                 if not hasattr(related_model, 'get_schemata_for_model'):
                     # okay, treat as ordinary model field
-                    return {lookup: value}
+                    return LookupPlan(LookupPlan.FIELD, lookup)
 
                 # check if sublookup is another schema
-                # TODO: handle nested sublookups (probably these blocks should be taken out of the Manager)
+                # TODO: handle nested sublookups
 
-                related_schemata = dict((s.name, s) for s in related_model.get_schemata_for_model())
-                if '__' in sublookup:
+                related_schemata = get_schema_registry(related_model).by_name
+                if sublookup and '__' in sublookup:
                     subname, subsublookup = sublookup.split('__', 1)
                 else:
                     subname, subsublookup = sublookup, None
                 if subname in related_schemata:
-                    # EAV attribute (Attr instance linked to entity)
-                    schema = related_schemata.get(subname)
-                    if schema.datatype in (schema.TYPE_ONE, schema.TYPE_MANY):
-                        d = self._filter_by_choice_schema(qs, subname, subsublookup, value, schema, model=related_model)
-                    elif schema.datatype == schema.TYPE_RANGE:
-                        d = self._filter_by_range_schema(qs, subname, subsublookup, value, schema)
-                    else:
-                        d = self._filter_by_simple_schema(qs, subname, subsublookup, value, schema)
-                    prefixed = dict(('%s__%s' % (name, k), v) for k, v in d.items())
-                    #assert 1==0, (schema, prefixed)
-                    return prefixed
+                    # EAV attribute (Attr instance linked to related entity)
+                    return LookupPlan(LookupPlan.RELATED_ATTR, lookup,
+                                      schema=related_schemata[subname],
+                                      sublookup=subsublookup,
+                                      model=related_model, prefix=name)
             # okay, treat as ordinary model field
-            return {lookup: value}
+            return LookupPlan(LookupPlan.FIELD, lookup)
 
         elif name in schemata:
             # EAV attribute (Attr instance linked to entity)
-            schema = schemata.get(name)
-            if schema.datatype in (schema.TYPE_ONE, schema.TYPE_MANY):
-                return self._filter_by_choice_schema(qs, name, sublookup, value, schema)
-            elif schema.datatype == schema.TYPE_RANGE:
-                return self._filter_by_range_schema(qs, name, sublookup, value, schema)
-            else:
-                return self._filter_by_simple_schema(qs, lookup, sublookup, value, schema)
+            return LookupPlan(LookupPlan.ATTR, lookup, schema=schemata[name],
+                              sublookup=sublookup, model=self.model)
         else:
             raise NameError('Cannot filter items by attributes: unknown '
                             'attribute "%s". Available fields: %s. '
                             'Available schemata: %s.' % (name,
                             ', '.join(fields), ', '.join(schemata)))
 
-    def _filter_by_simple_schema(self, qs, lookup, sublookup, value, schema):
+    def _filter_by_attrs(self, model, schema, conditions):
+        """
+        Returns lookups which select entities of given model that have an
+        attribute of given schema matching given conditions. The attribute
+        table is queried in a subquery (`pk IN (SELECT entity_id ...)`), so
+        each condition is independent of others: no joins are added to the
+        entity query and the results need not be made distinct.
+        """
+        attr_model = model.get_attr_model(schema)
+        lookups = get_entity_type_lookups(model, attr_model)
+        attrs = attr_model._default_manager.filter(
+            schema=schema, **dict(conditions, **lookups))
+        return {'pk__in': attrs.values_list('entity_id', flat=True)}
+
+    def _filter_by_simple_schema(self, qs, lookup, sublookup, value, schema, model=None):
         """
         Filters given entity queryset by an attribute which is linked to given
         schema and has given value in the field for schema's datatype.
         """
-        value_lookup = 'attrs__value_%s' % schema.datatype
+        value_lookup = 'value_%s' % schema.datatype
         if sublookup:
             value_lookup = '%s__%s' % (value_lookup, sublookup)
-        return {
-            'attrs__schema': schema,
+        return self._filter_by_attrs(model or self.model, schema, {
             str(value_lookup): value
-        }
+        })
 
-    def _filter_by_range_schema(self, qs, lookup, sublookup, value, schema):
+    def _filter_by_range_schema(self, qs, lookup, sublookup, value, schema, model=None):
         """
         Filters given entity queryset by an attribute which is linked to given
-        range schema. Lookups `between` yields items that lie not completely
-        within given range but have intersection with it. For example, and item
-        with x=(2,5) will match q=(3,None) or q=(0,3). See tests for details.
+        range schema. Lookup `overlaps` (default) yields items that lie not
+        completely within given range but have intersection with it. For
+        example, and item with x=(2,5) will match q=(3,None) or q=(0,3). See
+        tests for details. Lookup `contains` yields items which include given
+        range, lookup `within` yields items included in given range.
 
             qs.filter(weight_range__overlaps=(1,3))
             qs.filter(weight_range__overlaps=(1,None))
+            qs.filter(weight_range__within=(0,10))
 
+        If the attribute model has range buckets (see `BaseRangeBucket`),
+        candidate attributes are first looked up by bucket numbers.
         """
-        # This code was written with a single use case in mind. That use case
-        # required searching for objects whose ranges *intersect* with given
-        # one. I did not invest time in supporting other use cases (such as
-        # checking whether the ranges are exactly the same or how they are
-        # different). However, such lookups *can* be added later without
-        # breaking existing client code. Patches are welcome.
         sublookup = sublookup or RANGE_INTERSECTION_LOOKUP
-        if not sublookup == RANGE_INTERSECTION_LOOKUP:
-            raise ValueError('Range schema only supports lookup "%s".' %
-                             RANGE_INTERSECTION_LOOKUP)
+        if sublookup not in RANGE_LOOKUPS:
+            raise ValueError('Range schema only supports lookups "%s".' %
+                             '", "'.join(sorted(RANGE_LOOKUPS)))
         try:
             _, _ = value
         except ValueError:
@@ -164,15 +590,33 @@ class BaseEntityManager(Manager):
         except TypeError:
             raise TypeError('Expected a two-tuple, got "%s"' % value)
 
-        value_lookups = zip((
-            'attrs__value_range_max__gte',
-            'attrs__value_range_min__lte',
-        ), value)
+        value_lookups = zip(RANGE_LOOKUPS[sublookup], value)
         conditions = dict((k,v) for k,v in value_lookups if v is not None)
-        conditions.update({
-            'attrs__schema': schema,
-        })
-        return conditions
+        model = model or self.model
+        bucket_model = get_range_bucket_model(model.get_attr_model(schema))
+        if bucket_model is not None:
+            bucket_lookups = self._get_range_bucket_lookups(bucket_model, sublookup, value)
+            if bucket_lookups:
+                buckets = bucket_model._default_manager.filter(
+                    Q(**bucket_lookups) | Q(bucket__isnull=True), schema=schema)
+                conditions['pk__in'] = buckets.values_list('attr', flat=True)
+        return self._filter_by_attrs(model, schema, conditions)
+
+    def _get_range_bucket_lookups(self, bucket_model, sublookup, value):
+        # every stored range which matches given one is guaranteed to have
+        # a bucket row matching these lookups (or a NULL bucket if too wide)
+        low, high = value
+        get_bucket = bucket_model.get_bucket
+        if sublookup == RANGE_CONTAINS_LOOKUP:
+            if low is None or high is None:
+                return {}
+            return {'bucket': get_bucket(low)}
+        lookups = {}
+        if low is not None:
+            lookups['bucket__gte'] = get_bucket(low)
+        if high is not None:
+            lookups['bucket__lte'] = get_bucket(high)
+        return lookups
 
     def _filter_by_choice_schema(self, qs, lookup, sublookup, value, schema, model=None):
         """
@@ -180,17 +624,41 @@ class BaseEntityManager(Manager):
         choice schema.
         """
         model = model or self.model
-        schemata = dict((s.name, s) for s in model.get_schemata_for_model())   # TODO cache this dict, see above too
-        try:
-            schema = schemata[lookup]
-        except KeyError:
-            # TODO: smarter error message, i.e. how could this happen and what to do
-            raise ValueError(u'Could not find schema for lookup "%s"' % lookup)
         sublookup = '__%s'%sublookup if sublookup else ''
-        return {
-            'attrs__schema': schema,
-            'attrs__choice%s'%sublookup: value,  # TODO: can we filter by id, not name?
-        }
+        return self._filter_by_attrs(model, schema, {
+            str('choice%s'%sublookup): value,
+        })
+
+    def iterator(self):
+        iterator = super(BaseEntityQuerySet, self).iterator()
+        if self._prefetch_eav:
+            return self._iterator_with_eav(iterator)
+        return iterator
+
+    def _iterator_with_eav(self, iterator):
+        while True:
+            chunk = list(islice(iterator, EAV_PREFETCH_CHUNK_SIZE))
+            if not chunk:
+                return
+            self.model.populate_eav(chunk)
+            for instance in chunk:
+                yield instance
+
+
+class BaseEntityManager(Manager):
+
+    def get_query_set(self):
+        # Django < 1.2 does not support multiple databases
+        kwargs = {'using': self._db} if hasattr(self, '_db') else {}
+        return BaseEntityQuerySet(self.model, **kwargs)
+
+    def prefetch_eav(self):
+        "See :meth:`BaseEntityQuerySet.prefetch_eav`."
+        return self.get_query_set().prefetch_eav()
+
+    def values_eav(self, *names):
+        "See :meth:`BaseEntityQuerySet.values_eav`."
+        return self.get_query_set().values_eav(*names)
 
     def create(self, **kwargs):
         """
@@ -205,16 +673,7 @@ class BaseEntityManager(Manager):
         """
 
         fields = self.model._meta.get_all_field_names()
-        schemata = dict((s.name, s) for s in self.model.get_schemata_for_model())
-
-        # check if all attributes are known
-        possible_names = set(fields) | set(schemata.keys())
-        wrong_names = set(kwargs.keys()) - possible_names
-        if wrong_names:
-            raise NameError('Cannot create %s: unknown attribute(s) "%s". '
-                            'Available fields: (%s). Available schemata: (%s).'
-                            % (self.model._meta.object_name, '", "'.join(wrong_names),
-                               ', '.join(fields), ', '.join(schemata)))
+        self._check_names(kwargs, fields)
 
         # init entity with fields
         instance = self.model(**dict((k,v) for k,v in kwargs.items() if k in fields))
@@ -228,6 +687,231 @@ class BaseEntityManager(Manager):
 
         return instance
 
+    def _check_names(self, kwargs, fields):
+        "Raises NameError if some of given names are not fields or schemata."
+        schemata = get_schema_registry(self.model).by_name
+        possible_names = set(fields) | set(schemata.keys())
+        wrong_names = set(kwargs.keys()) - possible_names
+        if wrong_names:
+            raise NameError('Cannot create %s: unknown attribute(s) "%s". '
+                            'Available fields: (%s). Available schemata: (%s).'
+                            % (self.model._meta.object_name, '", "'.join(wrong_names),
+                               ', '.join(fields), ', '.join(schemata)))
+
+    def bulk_create_with_attrs(self, items, batch_size=EAV_BULK_BATCH_SIZE):
+        """
+        Creates many entity instances and related Attr instances. Each item
+        is a dictionary of keyword arguments as accepted by :meth:`create`.
+        Usage::
+
+            ConcreteEntity.objects.bulk_create_with_attrs([
+                {'title': 'Apple', 'colour': 'green'},
+                {'title': 'Orange', 'colour': 'orange', 'size': medium},
+            ])
+
+        Items are processed in batches of `batch_size`. All items of a batch
+        are validated before anything is written; each batch is then written
+        within a transaction with a single query for attributes. Entities are
+        inserted with a single query on PostgreSQL and SQLite, where IDs of
+        inserted rows can be obtained reliably; on other databases (or for
+        models with parents) they are inserted one by one.
+
+        Returns the list of created entity instances with attributes already
+        loaded. Their `save()` method is not called.
+        """
+        created = []
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) == batch_size:
+                created.extend(self._bulk_create_batch(batch))
+                batch = []
+        if batch:
+            created.extend(self._bulk_create_batch(batch))
+        return created
+
+    def _bulk_create_batch(self, items):
+        fields = self.model._meta.get_all_field_names()
+        # allow raw values for foreign keys (e.g. "rubric_id")
+        fields += [f.attname for f in self.model._meta.fields
+                   if f.attname not in fields]
+        schemata = get_schema_registry(self.model).by_name
+        snapshot_field = self.model.eav_snapshot_field
+        instances = []
+        attrs = []
+        for kwargs in items:
+            self._check_names(kwargs, fields)
+            instance = self.model(**dict((k,v) for k,v in kwargs.items() if k in fields))
+            instance._set_eav_cache([])
+            values = dict((k,v) for k,v in kwargs.items() if k in schemata)
+            for name, value in values.items():
+                # validates the value; attribute is not bound to entity yet
+                created, _, _ = schemata[name].get_attr_changes(instance, value, [])
+                attrs.append((instance, created))
+            if snapshot_field:
+                setattr(instance, snapshot_field, instance._dump_eav_snapshot(values))
+            instances.append(instance)
+        self._bulk_insert(instances, attrs)
+        return instances
+
+    @atomic
+    def _bulk_insert(self, instances, attrs):
+        if self._insert_entities(instances):
+            # bulk inserts do not send signals
+            bump_generation(ENTITIES)
+        else:
+            for instance in instances:
+                # skip BaseEntity.save(), attributes are inserted below
+                Model.save(instance, force_insert=True)
+        to_create = []
+        attrs_by_instance = dict((id(x), []) for x in instances)
+        for instance, created in attrs:
+            for attr in created:
+                attr.entity_id = instance.pk
+                to_create.append(attr)
+                attrs_by_instance[id(instance)].append(attr)
+        _save_attr_changes(to_create)
+        for instance in instances:
+            instance_attrs = attrs_by_instance[id(instance)]
+            instance_attrs.sort(key=lambda x: x.schema_id)
+            instance._set_eav_cache(instance_attrs)
+
+    def _insert_entities(self, instances):
+        """
+        Inserts given entity instances with multi-row queries and sets their
+        primary keys. Returns False (and inserts nothing) if the model or the
+        database does not allow to obtain IDs of inserted rows reliably, or
+        if some instances already have primary keys.
+        """
+        opts = self.model._meta
+        vendor = getattr(connection, 'vendor', None)
+        fields = [f for f in opts.local_fields if not isinstance(f, AutoField)]
+        if (opts.parents or not isinstance(opts.pk, AutoField) or
+            any(x.pk is not None for x in instances) or
+            vendor not in ('postgresql', 'sqlite') or
+            not getattr(connection.features, 'has_bulk_insert', False) or
+            any(hasattr(f, 'get_placeholder') for f in fields)):
+            return False
+        batch_size = len(instances)
+        if hasattr(connection.ops, 'bulk_batch_size'):    # Django >= 1.5
+            batch_size = max(connection.ops.bulk_batch_size(fields, instances), 1)
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        for start in range(0, len(instances), batch_size):
+            batch = instances[start:start + batch_size]
+            query = InsertQuery(self.model)
+            query.insert_values(fields, batch)
+            compiler = query.get_compiler(connection=connection)
+            compiler.return_id = False    # normally set by execute_sql()
+            sql, params = compiler.as_sql()[0]
+            if vendor == 'postgresql':
+                cursor.execute('%s RETURNING %s' % (sql, qn(opts.pk.column)), params)
+                ids = [row[0] for row in cursor.fetchall()]
+            else:
+                # SQLite serializes writes, so the rows get consecutive ids
+                cursor.execute(sql, params)
+                ids = range(cursor.lastrowid - len(batch) + 1, cursor.lastrowid + 1)
+            for instance, pk in zip(batch, ids):
+                instance.pk = pk
+                instance._state.adding = False
+                instance._state.db = connection.alias
+        return True
+
+
+@atomic
+def save_attrs_in_bulk(attr_model, to_create=(), to_update=(), to_delete=()):
+    """
+    Writes given attribute instances within a single transaction: deletes
+    stale rows with one query, inserts new rows with one query (if supported
+    by Django) and updates changed rows without extra SELECTs. Range buckets
+    are updated if the attribute model has them.
+    """
+    _save_attrs_in_bulk(attr_model, to_create, to_update, to_delete)
+
+
+def _save_attrs_in_bulk(attr_model, to_create, to_update, to_delete):
+    manager = attr_model._default_manager
+    if to_delete:
+        manager.filter(pk__in=[x.pk for x in to_delete]).delete()
+    to_create = list(to_create)
+    indexed = []
+    if to_create and get_range_bucket_model(attr_model) is not None:
+        # buckets refer to attributes, so primary keys must be known
+        indexed = [x for x in to_create if x.schema.datatype == x.schema.TYPE_RANGE]
+        for attr in indexed:
+            attr.save(force_insert=True)
+        indexed_ids = set(id(x) for x in indexed)
+        to_create = [x for x in to_create if id(x) not in indexed_ids]
+    if to_create:
+        if hasattr(manager, 'bulk_create'):
+            manager.bulk_create(to_create)
+        else:    # Django < 1.4
+            for attr in to_create:
+                attr.save(force_insert=True)
+    for attr in to_update:
+        attr.save(force_update=True)
+    update_range_buckets(attr_model, indexed + list(to_update))
+    if to_create or to_update or to_delete:
+        # bulk inserts do not send signals
+        bump_generation(ATTRS)
+
+
+@atomic
+def save_attr_changes(to_create=(), to_update=(), to_delete=()):
+    """
+    Same as :func:`save_attrs_in_bulk` but accepts instances of different
+    attribute models (see `BaseEntity.eav_attr_models`): changes are grouped
+    by model and each group is written in bulk.
+    """
+    _save_attr_changes(to_create, to_update, to_delete)
+
+
+def _save_attr_changes(to_create=(), to_update=(), to_delete=()):
+    changes = SortedDict()
+    for index, attrs in enumerate((to_create, to_update, to_delete)):
+        for attr in attrs:
+            changes.setdefault(type(attr), ([], [], []))[index].append(attr)
+    for attr_model, model_changes in changes.items():
+        _save_attrs_in_bulk(attr_model, *model_changes)
+
+
+def get_range_bucket_model(attr_model):
+    "Returns the range bucket model for given attribute model or None."
+    descriptor = getattr(attr_model, 'range_buckets', None)
+    return descriptor.related.model if descriptor else None
+
+
+def update_range_buckets(attr_model, attrs):
+    """
+    Rebuilds range buckets (see `BaseRangeBucket`) for given saved attribute
+    instances; attributes of other types are skipped. Does nothing if the
+    attribute model has no buckets. Can be used to index existing data::
+
+        update_range_buckets(Attr, Attr.objects.select_related('schema'))
+    """
+    bucket_model = get_range_bucket_model(attr_model)
+    if bucket_model is None:
+        return
+    attrs = [x for x in attrs if x.schema.datatype == x.schema.TYPE_RANGE]
+    if not attrs:
+        return
+    manager = bucket_model._default_manager
+    manager.filter(attr__in=[x.pk for x in attrs]).delete()
+    buckets = []
+    for attr in attrs:
+        if attr.value_range_min is None:
+            continue
+        for bucket in bucket_model.get_buckets(attr.value_range_min,
+                                               attr.value_range_max):
+            buckets.append(bucket_model(attr=attr, schema_id=attr.schema_id,
+                                        bucket=bucket))
+    if hasattr(manager, 'bulk_create'):
+        manager.bulk_create(buckets)
+    else:    # Django < 1.4
+        for bucket in buckets:
+            bucket.save(force_insert=True)
+
+
 '''
 class BaseSchemaManager(Manager):
 
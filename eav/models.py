@@ -22,9 +22,22 @@ Models
 ~~~~~~
 """
 
+# python
+import datetime
+import math
+try:
+    import json
+except ImportError:    # Python < 2.6
+    from django.utils import simplejson as json
+
 # django
+import django
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
+from django.db import connection
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.signals import post_delete, post_save, pre_delete
 from django.db.models import (BooleanField, CharField, DateField, FloatField,
                               ForeignKey, IntegerField, Model, NullBooleanField,
                               TextField)
@@ -36,19 +49,89 @@ from autoslug.settings import slugify
 #from view_shortcuts.decorators import cached_property
 
 # this app
-from managers import BaseEntityManager
-
-
-__all__ = ['BaseAttribute', 'BaseChoice', 'BaseEntity', 'BaseSchema']
+from caching import (ATTRS, ENTITIES, SCHEMATA, bump_generation,
+                     get_schema_registry)
+from managers import (BaseEntityManager, atomic, get_entities_lookups,
+                      get_entity_field_name, get_entity_type_lookups,
+                      save_attr_changes)
+
+
+__all__ = ['BaseAttribute', 'BaseBooleanAttribute', 'BaseChoice',
+           'BaseChoiceAttribute', 'BaseDateAttribute', 'BaseEntity',
+           'BaseEntityAttribute', 'BaseFloatAttribute', 'BaseGenericAttribute',
+           'BaseRangeAttribute', 'BaseRangeBucket', 'BaseSchema',
+           'BaseTextAttribute', 'BaseTypedAttribute']
+
+
+# composite indexes for typical EAV queries: filtering by schema and value,
+# sorting by value and selecting entity ids for subqueries (Django >= 1.5)
+ATTRIBUTE_INDEXES = [
+    ('schema', 'value_float', 'entity_id'),
+    ('schema', 'value_date', 'entity_id'),
+    ('schema', 'value_bool', 'entity_id'),
+    ('schema', 'choice', 'entity_id'),
+    ('schema', 'value_range_min', 'value_range_max'),
+]
+# MySQL cannot index TEXT columns without prefix length, so this index is
+# disabled there by default and may be created manually
+if getattr(settings, 'EAV_INDEX_TEXT_VALUES',
+           getattr(connection, 'vendor', None) != 'mysql'):
+    ATTRIBUTE_INDEXES.insert(1, ('schema', 'value_text'))
+
+RANGE_BUCKET_INDEXES = [
+    ('schema', 'bucket'),
+]
+
+
+def get_attribute_indexes(names, entity_field='entity_id'):
+    """
+    Returns those of `ATTRIBUTE_INDEXES` that only involve given value fields.
+    `entity_id` is replaced with given name of the field which refers to the
+    entity (e.g. the foreign key of `BaseEntityAttribute`).
+    """
+    names = set(names) | set(['schema', 'entity_id'])
+    return [tuple(entity_field if x == 'entity_id' else x for x in index)
+            for index in ATTRIBUTE_INDEXES if set(index) <= names]
 
 
 def slugify_attr_name(name):
     return slugify(name.replace('_', '-')).replace('-', '_')
 
 
-def get_entity_lookups(entity):
-    ctype = ContentType.objects.get_for_model(entity)
-    return {'entity_type': ctype, 'entity_id': entity.pk}
+def get_entity_lookups(entity, attr_model):
+    "Returns lookups which select attributes of given entity instance."
+    lookups = get_entity_type_lookups(type(entity), attr_model)
+    lookups[get_entity_field_name(attr_model)] = entity.pk
+    return lookups
+
+
+def get_new_attr_kwargs(entity, attr_model):
+    "Returns keyword arguments for a new attribute of given entity instance."
+    kwargs = get_entity_type_lookups(type(entity), attr_model)
+    kwargs['entity_id'] = entity.pk
+    return kwargs
+
+
+def pivot_attrs(attrs):
+    """
+    Returns a dictionary of attribute values keyed by schema name. Expects
+    attribute instances with schemata already fetched (e.g. through
+    `select_related`). Values of TYPE_MANY schemata are lists of choices
+    ordered by primary key.
+    """
+    values = {}
+    for attr in attrs:
+        schema = attr.schema
+        if schema.datatype == schema.TYPE_MANY:
+            choices = values.setdefault(schema.name, [])
+            if attr.value:
+                choices.append(attr.value)
+        elif schema.name not in values:
+            values[schema.name] = attr.value
+    for schema_name, value in values.items():
+        if isinstance(value, list):
+            value.sort(key=lambda choice: choice.pk)
+    return values
 
 
 class BaseSchema(Model):
@@ -105,7 +188,37 @@ class BaseSchema(Model):
         Returns available attributes for given entity instance.
         Handles many-to-one relations transparently.
         """
-        return self.attrs.filter(**get_entity_lookups(entity))
+        attr_model = type(entity).get_attr_model(self)
+        lookups = dict(get_entity_lookups(entity, attr_model), schema=self)
+        return attr_model._default_manager.filter(**lookups)
+
+    def is_value_changed(self, old_value, new_value):
+        """
+        Returns True if given attribute values differ. Choices are compared by
+        primary keys regardless of their order.
+        """
+        try:
+            old_value = self._get_comparable_value(old_value)
+            new_value = self._get_comparable_value(new_value)
+        except TypeError:
+            # unhashable garbage; let save_attr() complain about it
+            return True
+        return old_value != new_value
+
+    def _get_comparable_value(self, value):
+        if self.datatype in (self.TYPE_ONE, self.TYPE_MANY):
+            if value is None:
+                value = []
+            if not hasattr(value, '__iter__'):
+                value = [value]
+            return frozenset(x.pk if isinstance(x, BaseChoice) else x
+                             for x in value)
+        if self.datatype == self.TYPE_RANGE:
+            if value is None or not hasattr(value, '__iter__'):
+                return value
+            value = tuple(value)
+            return None if value == (None, None) else value
+        return value
 
     def save_attr(self, entity, value):
         """
@@ -126,39 +239,97 @@ class BaseSchema(Model):
           processed as above (i.e. "foo" --> ["foo"]).
         """
 
-        if self.datatype in (self.TYPE_ONE, self.TYPE_MANY):
-            self._save_choice_attr(entity, value)
+        changes = self.get_attr_changes(entity, value, self.get_attrs(entity))
+        save_attr_changes(*changes)
+        if getattr(entity, 'eav_snapshot_field', None):
+            entity.update_eav_snapshot()
         else:
-            self._save_single_attr(entity, value)
+            entity.refresh_eav()
+
+    def dump_value(self, value):
+        """
+        Returns given attribute value in a JSON-serializable form. Choices are
+        represented by primary keys.
+        """
+        if value is None:
+            return None
+        if self.datatype in (self.TYPE_ONE, self.TYPE_MANY):
+            if not hasattr(value, '__iter__'):
+                value = [value]
+            pks = sorted(x.pk for x in value)
+            if self.datatype == self.TYPE_ONE:
+                return pks[0] if pks else None
+            return pks
+        if self.datatype == self.TYPE_RANGE:
+            value = tuple(value)
+            if value == (None, None):
+                return None
+            return [x if x is None else float(x) for x in value]
+        if self.datatype == self.TYPE_DATE:
+            return value.isoformat() if hasattr(value, 'isoformat') else value
+        if self.datatype == self.TYPE_FLOAT:
+            return float(value)
+        if self.datatype == self.TYPE_BOOLEAN:
+            return bool(value)
+        return unicode(value)
+
+    def load_value(self, data, choices=None):
+        """
+        Converts the output of :meth:`dump_value` back to attribute value.
 
-    def _save_single_attr(self, entity, value=None, schema=None,
-                          create_nulls=False, extra={}):
+        :param choices: list of choice instances for this schema. If not
+            given, choices are fetched from the database.
         """
-        Creates or updates an EAV attribute for given entity with given value.
+        if data is None:
+            return None
+        if self.datatype in (self.TYPE_ONE, self.TYPE_MANY):
+            if choices is None:
+                choices = self.get_choices()
+            choices = dict((x.pk, x) for x in choices)
+            if self.datatype == self.TYPE_ONE:
+                return choices.get(data)
+            return [choices[pk] for pk in data if pk in choices]
+        if self.datatype == self.TYPE_RANGE:
+            return tuple(data)
+        if self.datatype == self.TYPE_DATE:
+            return datetime.date(*[int(x) for x in data.split('-')])
+        return data
+
+    def get_attr_changes(self, entity, value, attrs):
+        """
+        Returns a tuple of three lists: attribute instances to be created,
+        updated and deleted in order to store given value for given entity.
+        Nothing is written to the database. See :meth:`save_attr` for details
+        on value processing.
 
-        :param schema: schema for attribute. Default it current schema instance.
-        :param create_nulls: boolean: if True, even attributes with value=None
-            are created (by default they are skipped).
-        :param extra: dict: additional data for Attr instance (e.g. title).
+        :param attrs: attributes of this schema currently stored for the entity.
         """
-        # If schema is not many-to-one, the value is saved to the corresponding
-        # Attr instance (which is created or updated).
+        if self.datatype in (self.TYPE_ONE, self.TYPE_MANY):
+            return self._get_choice_attr_changes(entity, value, attrs)
+        else:
+            return self._get_single_attr_changes(entity, value, attrs)
 
-        schema = schema or self
-        lookups = dict(get_entity_lookups(entity), schema=schema, **extra)
-        try:
-            attr = self.attrs.get(**lookups)
-        except self.attrs.model.DoesNotExist:
-            attr = self.attrs.model(**lookups)
-        if create_nulls or value != attr.value:
-            attr.value = value
-            for k,v in extra.items():
-                setattr(attr, k, v)
-            attr.save()
-
-    def _save_choice_attr(self, entity, value):
+    def _get_single_attr_changes(self, entity, value, attrs):
+        """
+        Returns changes for a non-choice attribute: the attribute is created or
+        updated. Attributes with value=None are not created.
         """
-        Creates or updates BaseChoice(s) attribute(s) for given entity.
+        attrs = list(attrs)
+        if attrs:
+            attr = attrs[0]
+        else:
+            attr_model = type(entity).get_attr_model(self)
+            attr = attr_model(schema=self, **get_new_attr_kwargs(entity, attr_model))
+        if value == attr.value:
+            return [], [], []
+        attr.value = value
+        if attr.pk is None:
+            return [attr], [], []
+        return [], [attr], []
+
+    def _get_choice_attr_changes(self, entity, value, attrs):
+        """
+        Returns changes for BaseChoice(s) attribute(s) of given entity.
         """
 
         # value can be None to reset choices from schema
@@ -178,17 +349,21 @@ class BaseSchema(Model):
                             'must be a BaseChoice instance.'
                             % value)
 
-        # drop all attributes for this entity/schema pair
-        self.get_attrs(entity).delete()
-
-        # Attr instances for corresponding managed choice schemata are updated
-        for choice in value:
-            self._save_single_attr(
-                entity,
-                schema = self,
-                create_nulls = True,
-                extra = {'choice': choice}
-            )
+        # only touch the difference between stored and requested choices
+        requested = dict((choice.pk, choice) for choice in value)
+        stored = set()
+        deleted = []
+        for attr in attrs:
+            if attr.choice_id in requested and attr.choice_id not in stored:
+                stored.add(attr.choice_id)
+            else:
+                deleted.append(attr)
+        attr_model = type(entity).get_attr_model(self)
+        kwargs = get_new_attr_kwargs(entity, attr_model)
+        created = [attr_model(schema=self, choice=choice, **kwargs)
+                   for pk, choice in sorted(requested.items())
+                   if pk not in stored]
+        return created, [], deleted
 
 
 class BaseEntity(Model):
@@ -199,15 +374,45 @@ class BaseEntity(Model):
 
     objects = BaseEntityManager()
 
+    # name of a TextField which stores a serialized snapshot of attribute
+    # values. If set, reading attributes does not query the database at all;
+    # the snapshot is updated on save.
+    eav_snapshot_field = None
+
+    # dictionary of "narrow" attribute models (see `BaseTypedAttribute`)
+    # keyed by schema datatype, e.g. {'text': TextAttr, 'float': FloatAttr}.
+    # Values of datatypes missing here are stored in the `attrs` relation.
+    eav_attr_models = None
+
     class Meta:
         abstract = True
 
-    def save(self, force_eav=False, **kwargs):
+    @atomic
+    def save(self, force_eav=False, eav_fields=None, **kwargs):
         """
         Saves entity instance and creates/updates related attribute instances.
 
-        :param eav: if True (default), EAV attributes are saved along with entity.
+        Only attributes whose values differ from those loaded from the database
+        are saved unless `force_eav` or `eav_fields` is specified.
+
+        :param force_eav: if True, all EAV attributes are saved regardless of
+            whether they have been changed.
+        :param eav_fields: list of attribute names. If given, only attributes
+            with these names are saved (whether changed or not).
         """
+        if eav_fields is not None:
+            wrong_names = set(eav_fields) - set(self.get_schema_names())
+            if wrong_names:
+                raise NameError('Cannot save %s: unknown attribute(s) "%s". '
+                                'Available schemata: (%s).'
+                                % (self._meta.object_name,
+                                   '", "'.join(wrong_names),
+                                   ', '.join(self.get_schema_names())))
+
+        if self.pk is None or kwargs.get('force_insert'):
+            # a new entity has no stored attributes, no need to query them
+            self._set_eav_cache([])
+
         # save entity
         super(BaseEntity, self).save(**kwargs)
 
@@ -219,29 +424,206 @@ class BaseEntity(Model):
         #                  % type(self), RuntimeWarning)
 
 
-        # create/update EAV attributes
+        # create/update EAV attributes; stored attributes are fetched once,
+        # then all changes are written in bulk (in the same transaction as
+        # the entity)
+        stored_attrs = {}
+        for attr in self._get_eav_attrs():
+            stored_attrs.setdefault(attr.schema_id, []).append(attr)
+        to_create, to_update, to_delete = [], [], []
+        new_values = {}
         for schema in self.get_schemata():
+            stored_value = self._get_stored_eav_value(schema)
+            new_values[schema.name] = stored_value
+            if eav_fields is not None and schema.name not in eav_fields:
+                continue
             value = getattr(self, schema.name, None)
-            schema.save_attr(self, value)
+            if eav_fields is None and not force_eav:
+                if not schema.is_value_changed(stored_value, value):
+                    continue
+            new_values[schema.name] = value
+            attrs = stored_attrs.get(schema.pk, [])
+            created, updated, deleted = schema.get_attr_changes(self, value, attrs)
+            to_create.extend(created)
+            to_update.extend(updated)
+            to_delete.extend(deleted)
+        save_attr_changes(to_create, to_update, to_delete)
+
+        # cached attributes (if any) may be outdated now
+        self.refresh_eav()
+
+        if self.eav_snapshot_field:
+            self._save_eav_snapshot(new_values)
 
     def __getattr__(self, name):
         if not name.startswith('_'):
             if name in self.get_schema_names():
-                schema = self.get_schema(name)
-                attrs = schema.get_attrs(self)
-                if schema.datatype == schema.TYPE_MANY:
-                    return [a.value for a in attrs if a.value]
-                else:
-                    return attrs[0].value if attrs else None
+                return self._get_stored_eav_value(self.get_schema(name))
         raise AttributeError('%s does not have attribute named "%s".' %
                              (self._meta.object_name, name))
 
     def __iter__(self):
         "Iterates over non-empty EAV attributes. Normal fields are not included."
-        for attr in self.attrs.select_related():
+        for attr in self._get_eav_attrs():
             if getattr(self, attr.schema.name, None):
                 yield attr
 
+    @classmethod
+    def get_attr_model(cls, schema=None):
+        """
+        Returns the concrete attribute model which stores values of given
+        schema for this entity model. If `eav_attr_models` is not set, this
+        is the model linked via the `attrs` relation regardless of schema:
+        either a generic relation or a foreign key on the attribute model
+        (see `BaseEntityAttribute`).
+        """
+        if cls.eav_attr_models:
+            if schema is None:
+                raise TypeError('%s stores attributes in multiple models; '
+                                'schema is required to choose one.'
+                                % cls._meta.object_name)
+            if schema.datatype in cls.eav_attr_models:
+                return cls.eav_attr_models[schema.datatype]
+        return cls._get_attrs_relation_model()
+
+    @classmethod
+    def _get_attrs_relation_model(cls):
+        # `attrs` is either a generic relation or the reverse side of
+        # a foreign key (see `BaseEntityAttribute`)
+        field = cls._meta.get_field_by_name('attrs')[0]
+        return field.rel.to if hasattr(field, 'rel') else field.model
+
+    @classmethod
+    def get_attr_models(cls):
+        "Returns the list of all attribute models used by this entity model."
+        if not cls.eav_attr_models:
+            return [cls.get_attr_model()]
+        models = []
+        for attr_model in cls.eav_attr_models.values():
+            if attr_model not in models:
+                models.append(attr_model)
+        try:
+            # datatypes missing from `eav_attr_models` are stored in `attrs`
+            attr_model = cls._get_attrs_relation_model()
+        except FieldDoesNotExist:
+            return models
+        if attr_model not in models:
+            models.append(attr_model)
+        return models
+
+    @classmethod
+    def populate_eav(cls, instances):
+        """
+        Loads EAV attributes for given entity instances with a single query
+        (per attribute model) and caches them on each instance, so that
+        subsequent access to the attributes does not hit the database.
+        """
+        instances = [x for x in instances if x.pk is not None]
+        if not instances:
+            return
+        pks = [x.pk for x in instances]
+        attrs_by_entity = dict((pk, []) for pk in pks)
+        for attr_model in cls.get_attr_models():
+            lookups = get_entities_lookups(cls, pks, attr_model)
+            attrs = attr_model._default_manager.filter(**lookups)
+            related = ['schema']
+            if 'choice' in attr_model._meta.get_all_field_names():
+                related.append('choice')
+            attrs = attrs.select_related(*related)
+            for attr in attrs:
+                attrs_by_entity[attr.entity_id].append(attr)
+        for instance in instances:
+            attrs = attrs_by_entity[instance.pk]
+            attrs.sort(key=lambda x: (x.schema_id, x.pk))
+            instance._set_eav_cache(attrs)
+
+    def _set_eav_cache(self, attrs):
+        self._eav_attrs_cache = list(attrs)
+        self._eav_values_cache = pivot_attrs(self._eav_attrs_cache)
+
+    def _load_eav_cache(self):
+        if self.__dict__.get('_eav_attrs_cache') is None:
+            if self.pk is None:
+                self._set_eav_cache([])
+            else:
+                type(self).populate_eav([self])
+
+    def _get_eav_attrs(self):
+        "Returns the list of attribute instances stored for this entity."
+        self._load_eav_cache()
+        return self._eav_attrs_cache
+
+    def _get_eav_values(self):
+        "Returns a dictionary of stored attribute values keyed by schema name."
+        if self.__dict__.get('_eav_values_cache') is None:
+            self._eav_values_cache = self._load_eav_snapshot()
+        if self._eav_values_cache is None:
+            self._eav_values_cache = pivot_attrs(self._get_eav_attrs())
+        return self._eav_values_cache
+
+    def _get_stored_eav_value(self, schema):
+        values = self._get_eav_values()
+        if schema.datatype == schema.TYPE_MANY:
+            return list(values.get(schema.name, []))
+        return values.get(schema.name)
+
+    def refresh_eav(self):
+        """
+        Drops cached EAV attributes. All attributes of the entity will be
+        reloaded with a single query on next access.
+
+        Note that values assigned directly to the instance are not affected.
+        The attribute snapshot (if any) is not used until the entity is saved
+        again because the snapshot field itself may be outdated.
+        """
+        self._eav_attrs_cache = None
+        self._eav_values_cache = None
+        self._eav_snapshot_stale = True
+
+    def _load_eav_snapshot(self):
+        field_name = self.eav_snapshot_field
+        if not field_name or self.__dict__.get('_eav_snapshot_stale'):
+            return None
+        data = getattr(self, field_name)
+        if not data:
+            return None
+        registry = get_schema_registry(type(self))
+        values = {}
+        for name, value in json.loads(data).items():
+            schema = registry.by_name.get(name)
+            if schema:
+                choices = registry.get_choices(schema)
+                values[schema.name] = schema.load_value(value, choices)
+        return values
+
+    def _dump_eav_snapshot(self, values):
+        data = {}
+        for schema in self.get_schemata():
+            value = schema.dump_value(values.get(schema.name))
+            if value not in (None, []):
+                data[schema.name] = value
+        return json.dumps(data, sort_keys=True)
+
+    def _save_eav_snapshot(self, values):
+        data = self._dump_eav_snapshot(values)
+        field_name = self.eav_snapshot_field
+        if data != getattr(self, field_name):
+            manager = type(self)._default_manager
+            manager.filter(pk=self.pk).update(**{field_name: data})
+            setattr(self, field_name, data)
+        self._eav_snapshot_stale = False
+        self._eav_values_cache = None
+
+    def update_eav_snapshot(self):
+        """
+        Rebuilds the attribute snapshot from stored attributes and saves it.
+        Useful after attributes were modified bypassing `BaseEntity.save()`
+        or when the snapshot field is added to an existing model.
+        """
+        self.refresh_eav()
+        self._save_eav_snapshot(dict((s.name, self._get_stored_eav_value(s))
+                                     for s in self.get_schemata()))
+
     @classmethod
     def get_schemata_for_model(cls):
         return NotImplementedError('BaseEntity subclasses must define method '
@@ -255,7 +637,11 @@ class BaseEntity(Model):
         if hasattr(self, '_schemata_cache') and self._schemata_cache is not None:
             return self._schemata_cache
         all_schemata = self.get_schemata_for_model().select_related()
-        self._schemata_cache = self.get_schemata_for_instance(all_schemata)
+        schemata = self.get_schemata_for_instance(all_schemata)
+        if schemata is all_schemata:
+            # not narrowed down for this instance; use process-wide cache
+            schemata = get_schema_registry(type(self)).schemata
+        self._schemata_cache = schemata
         self._schemata_cache_dict = dict((s.name, s) for s in self._schemata_cache)
         return self._schemata_cache
 
@@ -317,29 +703,19 @@ class BaseChoice(Model):
         return self.title   #u'%s "%s"' % (self.schema.title, self.title)
 
 
-class BaseAttribute(Model):
-    """ Base class for choices.  Concrete choice class must overload the
-    `schema` and `choice` attributes.
+class BaseTypedAttribute(Model):
+    """ Base class for attributes.  Links a value to a schema; subclasses
+    define how the attribute refers to its entity and which columns store
+    values.  The entity is referenced either generically (see
+    `BaseGenericAttribute`) or with a foreign key named `entity` (see
+    `BaseEntityAttribute`).  Concrete attribute class must overload the
+    `schema` attribute.
     """
-    entity_type = ForeignKey(ContentType)
-    entity_id = IntegerField()
-    entity = generic.GenericForeignKey(ct_field="entity_type", fk_field='entity_id')
-
-    value_text = TextField(blank=True, null=True)
-    value_float = FloatField(blank=True, null=True)
-    value_date = DateField(blank=True, null=True)
-    value_bool = NullBooleanField(blank=True)    # TODO: ensure that form invalidates null booleans (??)
-    value_range_min = FloatField(blank=True, null=True)
-    value_range_max = FloatField(blank=True, null=True)
-
     schema = NotImplemented    # must be FK
-    choice = NotImplemented    # must be nullable FK
 
     class Meta:
         abstract = True
         verbose_name, verbose_name_plural = _('attribute'), _('attributes')
-        ordering = ['entity_type', 'entity_id', 'schema']
-        unique_together = ('entity_type', 'entity_id', 'schema', 'choice')
 
     def __unicode__(self):
         return u'%s: %s "%s"' % (self.entity, self.schema.title, self.value)
@@ -372,6 +748,207 @@ class BaseAttribute(Model):
     value = property(_get_value, _set_value)
 
 
+
+class BaseGenericAttribute(BaseTypedAttribute):
+    """ Base class for attributes which refer to entities of any model via
+    content type.  Values are stored in columns defined by subclasses.
+    """
+    entity_type = ForeignKey(ContentType)
+    entity_id = IntegerField()
+    entity = generic.GenericForeignKey(ct_field="entity_type", fk_field='entity_id')
+
+    class Meta:
+        abstract = True
+        verbose_name, verbose_name_plural = _('attribute'), _('attributes')
+        ordering = ['entity_type', 'entity_id', 'schema']
+
+
+class BaseAttribute(BaseGenericAttribute):
+    """ Base class for attributes of all datatypes.  Concrete attribute class
+    must overload the `schema` and `choice` attributes.
+    """
+    value_text = TextField(blank=True, null=True)
+    value_float = FloatField(blank=True, null=True)
+    value_date = DateField(blank=True, null=True)
+    value_bool = NullBooleanField(blank=True)    # TODO: ensure that form invalidates null booleans (??)
+    value_range_min = FloatField(blank=True, null=True)
+    value_range_max = FloatField(blank=True, null=True)
+
+    schema = NotImplemented    # must be FK
+    choice = NotImplemented    # must be nullable FK
+
+    class Meta:
+        abstract = True
+        verbose_name, verbose_name_plural = _('attribute'), _('attributes')
+        ordering = ['entity_type', 'entity_id', 'schema']
+        unique_together = ('entity_type', 'entity_id', 'schema', 'choice')
+        if django.VERSION >= (1, 5):
+            index_together = ATTRIBUTE_INDEXES
+
+
+class BaseEntityAttribute(BaseTypedAttribute):
+    """ Base class for attributes of all datatypes which belong to a single
+    entity model.  Unlike `BaseAttribute`, the entity is referenced with a
+    real foreign key, so no content type is stored or matched, the entity
+    column can be indexed alone and attributes are deleted along with the
+    entity.  Concrete attribute class must overload the `entity`, `schema`
+    and `choice` attributes::
+
+        class ProductAttr(BaseEntityAttribute):
+            entity = models.ForeignKey(Product, related_name='attrs')
+            schema = models.ForeignKey(Schema, related_name='product_attrs')
+            choice = models.ForeignKey(Choice, related_name='product_attrs', null=True)
+    """
+    value_text = TextField(blank=True, null=True)
+    value_float = FloatField(blank=True, null=True)
+    value_date = DateField(blank=True, null=True)
+    value_bool = NullBooleanField(blank=True)
+    value_range_min = FloatField(blank=True, null=True)
+    value_range_max = FloatField(blank=True, null=True)
+
+    entity = NotImplemented    # must be FK with related_name='attrs'
+    schema = NotImplemented    # must be FK
+    choice = NotImplemented    # must be nullable FK
+
+    class Meta:
+        abstract = True
+        verbose_name, verbose_name_plural = _('attribute'), _('attributes')
+        ordering = ['entity', 'schema']
+        unique_together = ('entity', 'schema', 'choice')
+        if django.VERSION >= (1, 5):
+            index_together = get_attribute_indexes(
+                ['value_text', 'value_float', 'value_date', 'value_bool',
+                 'choice', 'value_range_min', 'value_range_max'],
+                entity_field='entity')
+
+
+class BaseTextAttribute(BaseGenericAttribute):
+    "Narrow attribute for `BaseSchema.TYPE_TEXT`."
+    value_text = TextField(blank=True, null=True)
+
+    class Meta:
+        abstract = True
+        verbose_name, verbose_name_plural = _('text attribute'), _('text attributes')
+        ordering = ['entity_type', 'entity_id', 'schema']
+        unique_together = ('entity_type', 'entity_id', 'schema')
+        if django.VERSION >= (1, 5):
+            index_together = get_attribute_indexes(['value_text'])
+
+
+class BaseFloatAttribute(BaseGenericAttribute):
+    "Narrow attribute for `BaseSchema.TYPE_FLOAT`."
+    value_float = FloatField(blank=True, null=True)
+
+    class Meta:
+        abstract = True
+        verbose_name, verbose_name_plural = _('number attribute'), _('number attributes')
+        ordering = ['entity_type', 'entity_id', 'schema']
+        unique_together = ('entity_type', 'entity_id', 'schema')
+        if django.VERSION >= (1, 5):
+            index_together = get_attribute_indexes(['value_float'])
+
+
+class BaseDateAttribute(BaseGenericAttribute):
+    "Narrow attribute for `BaseSchema.TYPE_DATE`."
+    value_date = DateField(blank=True, null=True)
+
+    class Meta:
+        abstract = True
+        verbose_name, verbose_name_plural = _('date attribute'), _('date attributes')
+        ordering = ['entity_type', 'entity_id', 'schema']
+        unique_together = ('entity_type', 'entity_id', 'schema')
+        if django.VERSION >= (1, 5):
+            index_together = get_attribute_indexes(['value_date'])
+
+
+class BaseBooleanAttribute(BaseGenericAttribute):
+    "Narrow attribute for `BaseSchema.TYPE_BOOLEAN`."
+    value_bool = NullBooleanField(blank=True)
+
+    class Meta:
+        abstract = True
+        verbose_name, verbose_name_plural = _('boolean attribute'), _('boolean attributes')
+        ordering = ['entity_type', 'entity_id', 'schema']
+        unique_together = ('entity_type', 'entity_id', 'schema')
+        if django.VERSION >= (1, 5):
+            index_together = get_attribute_indexes(['value_bool'])
+
+
+class BaseRangeAttribute(BaseGenericAttribute):
+    "Narrow attribute for `BaseSchema.TYPE_RANGE`."
+    value_range_min = FloatField(blank=True, null=True)
+    value_range_max = FloatField(blank=True, null=True)
+
+    class Meta:
+        abstract = True
+        verbose_name, verbose_name_plural = _('range attribute'), _('range attributes')
+        ordering = ['entity_type', 'entity_id', 'schema']
+        unique_together = ('entity_type', 'entity_id', 'schema')
+        if django.VERSION >= (1, 5):
+            index_together = get_attribute_indexes(['value_range_min', 'value_range_max'])
+
+
+class BaseChoiceAttribute(BaseGenericAttribute):
+    """ Narrow attribute for `BaseSchema.TYPE_ONE` and `BaseSchema.TYPE_MANY`.
+    Concrete class must overload the `schema` and `choice` attributes.
+    """
+    choice = NotImplemented    # must be nullable FK
+
+    class Meta:
+        abstract = True
+        verbose_name, verbose_name_plural = _('choice attribute'), _('choice attributes')
+        ordering = ['entity_type', 'entity_id', 'schema']
+        unique_together = ('entity_type', 'entity_id', 'schema', 'choice')
+        if django.VERSION >= (1, 5):
+            index_together = get_attribute_indexes(['choice'])
+
+
+class BaseRangeBucket(Model):
+    """ Optional index for range attributes.  Each range is split into numbered
+    buckets of `bucket_size`; a row is stored for each bucket the range
+    overlaps.  Range lookups then select candidate attributes by bucket
+    number, which an ordinary index handles well, and check exact bounds only
+    for these candidates.  Ranges that span more than `max_buckets` buckets
+    are stored as a single row with NULL bucket and are always checked.
+
+    Concrete bucket class must overload the `attr` and `schema` attributes;
+    `attr` must be a ForeignKey to the attribute model with
+    ``related_name='range_buckets'``.  Buckets are maintained automatically
+    when attributes are saved through EAV-Django; use
+    `eav.managers.update_range_buckets` to index existing attributes.
+    """
+    bucket = IntegerField(blank=True, null=True, db_index=True)
+
+    attr = NotImplemented      # must be FK with related_name='range_buckets'
+    schema = NotImplemented    # must be FK
+
+    bucket_size = 10.0
+    max_buckets = 100
+
+    class Meta:
+        abstract = True
+        verbose_name, verbose_name_plural = _('range bucket'), _('range buckets')
+        unique_together = ('attr', 'bucket')
+        if django.VERSION >= (1, 5):
+            index_together = RANGE_BUCKET_INDEXES
+
+    def __unicode__(self):
+        return u'%s: bucket %s' % (self.attr, self.bucket)
+
+    @classmethod
+    def get_bucket(cls, value):
+        "Returns number of the bucket given value belongs to."
+        return int(math.floor(value / cls.bucket_size))
+
+    @classmethod
+    def get_buckets(cls, low, high):
+        "Returns list of bucket numbers given range overlaps."
+        first, last = cls.get_bucket(low), cls.get_bucket(high)
+        if last - first >= cls.max_buckets:
+            return [None]
+        return range(first, last + 1)
+
+
 def validate_range_value(value):
     """
     Validates given value against `Schema.TYPE_RANGE` data type. Raises
@@ -395,4 +972,36 @@ def validate_range_value(value):
     return
 
 
-# xxx catch signal Attr.post_save() --> update attr.item.attribute_cache (JSONField or such)
+def _invalidate_schemata(sender, **kwargs):
+    if issubclass(sender, (BaseSchema, BaseChoice)):
+        bump_generation(SCHEMATA)
+
+post_save.connect(_invalidate_schemata, dispatch_uid='eav_invalidate_schemata_on_save')
+post_delete.connect(_invalidate_schemata, dispatch_uid='eav_invalidate_schemata_on_delete')
+
+
+def _invalidate_attrs(sender, **kwargs):
+    if issubclass(sender, BaseTypedAttribute):
+        bump_generation(ATTRS)
+
+post_save.connect(_invalidate_attrs, dispatch_uid='eav_invalidate_attrs_on_save')
+post_delete.connect(_invalidate_attrs, dispatch_uid='eav_invalidate_attrs_on_delete')
+
+
+def _invalidate_entities(sender, **kwargs):
+    if issubclass(sender, BaseEntity):
+        bump_generation(ENTITIES)
+
+post_save.connect(_invalidate_entities, dispatch_uid='eav_invalidate_entities_on_save')
+post_delete.connect(_invalidate_entities, dispatch_uid='eav_invalidate_entities_on_delete')
+
+
+def _delete_typed_attrs(sender, instance, **kwargs):
+    # attributes in `eav_attr_models` are not necessarily linked to entities
+    # with a relation that cascades on delete
+    if issubclass(sender, BaseEntity) and sender.eav_attr_models:
+        for attr_model in set(sender.eav_attr_models.values()):
+            lookups = get_entity_lookups(instance, attr_model)
+            attr_model._default_manager.filter(**lookups).delete()
+
+pre_delete.connect(_delete_typed_attrs, dispatch_uid='eav_delete_typed_attrs')
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+#
+#    EAV-Django is a reusable Django application which implements EAV data model
+#    Copyright © 2009—2010  Andrey Mikhaylenko
+#
+#    This file is part of EAV-Django.
+#
+#    EAV-Django is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Lesser General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    EAV-Django is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public License
+#    along with EAV-Django.  If not, see <http://gnu.org/licenses/>.
+"""
+Pagination
+~~~~~~~~~~
+
+Facet sets are paginated by *keyset*: instead of skipping N rows with OFFSET,
+each page starts right after the sort key and primary key of the last item of
+the previous page. The position is passed around as an opaque cursor string,
+so deep pages cost the same as the first one. Usage::
+
+    paginator = FacetSetPaginator(facet_set, per_page=20)
+    page = paginator.page(after=request.GET.get('after'),
+                          before=request.GET.get('before'))
+    for item in page:
+        ...
+    page.next_cursor        # pass as `after` to get the next page
+    page.previous_cursor    # pass as `before` to get the previous page
+    paginator.count         # cached
+"""
+
+# python
+import base64
+try:
+    import json
+except ImportError:    # Python < 2.6
+    from django.utils import simplejson as json
+
+# django
+from django import forms
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection
+from django.db.models.query import EmptyQuerySet
+from django.utils.datastructures import SortedDict
+
+# this app
+from caching import get_cache_key, get_query_key
+from facets import FACET_CACHE_NAMESPACES, FACET_CACHE_TIMEOUT
+from managers import NULLS_FIRST
+
+
+__all__ = ['FacetSetPaginator', 'KeysetPage', 'InvalidCursor']
+
+
+SORT_KEY_ALIAS = 'eav_page_key'
+SORT_KEY_ISNULL_ALIAS = 'eav_page_key_isnull'
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(key, pk):
+    "Returns an URL-safe string which points to given position."
+    data = json.dumps([key, pk], cls=DjangoJSONEncoder)
+    return base64.urlsafe_b64encode(data)
+
+
+def decode_cursor(cursor):
+    "Returns a tuple `(key, pk)` encoded in given cursor."
+    try:
+        key, pk = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        raise InvalidCursor('Cannot decode cursor "%s".' % cursor)
+    return key, pk
+
+
+class KeysetPage(object):
+    """
+    A page of items. Iterable; provides cursors to adjacent pages (None if
+    there is no such page).
+    """
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __repr__(self):
+        return '<KeysetPage: %d items>' % len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+
+class FacetSetPaginator(object):
+    """
+    Splits items found by given facet set into pages of `per_page` items.
+    Items are sorted as in the facet set (by `order_by` and `order_desc` in
+    its data) and then by primary key, so that the order is total.
+
+    :param max_count: if given, items are counted up to this number;
+        `count_is_exact` tells whether the limit was reached. This keeps
+        counting cheap for huge result sets.
+    """
+    def __init__(self, facet_set, per_page, max_count=None):
+        self.facet_set = facet_set
+        self.per_page = per_page
+        self.max_count = max_count
+
+    def _get_count(self):
+        if self.facet_set.cache_results:
+            # the facet set has cached the count anyway
+            return len(self.facet_set)
+        qs = self.facet_set.object_list.order_by()
+        if self.max_count is None:
+            return qs.count()
+        return qs[:self.max_count].count()
+
+    @property
+    def count(self):
+        """
+        Returns the number of found items (see `max_count`). The number is
+        cached until entities, attributes or schemata change.
+        """
+        if not hasattr(self, '_count'):
+            try:
+                data = self.facet_set.get_normalized_data()
+            except forms.ValidationError:
+                return 0
+            key = get_cache_key('facet-count', [
+                self.facet_set.cache_prefix,
+                get_query_key(self.facet_set.get_queryset()),
+                data, self.max_count], FACET_CACHE_NAMESPACES)
+            self._count = cache.get(key)
+            if self._count is None:
+                self._count = self._get_count()
+                cache.set(key, self._count, FACET_CACHE_TIMEOUT)
+        return self._count
+
+    @property
+    def count_is_exact(self):
+        return self.max_count is None or self.count < self.max_count
+
+    def _get_sort_key(self):
+        "Returns sort key name (or 'pk') and whether the order is descending."
+        name = self.facet_set.data.get('order_by')
+        if not name:
+            return 'pk', False
+        return name, bool(self.facet_set.data.get('order_desc'))
+
+    def page(self, after=None, before=None):
+        """
+        Returns a :class:`KeysetPage` which starts right after the position
+        given by cursor `after` or ends right before the position given by
+        cursor `before`. If no cursor is given, the first page is returned.
+        Raises :class:`InvalidCursor` if the cursor cannot be decoded.
+        """
+        if after and before:
+            raise ValueError('Expected either "after" or "before" cursor.')
+        qs = self.facet_set.object_list
+        if isinstance(qs, EmptyQuerySet):
+            return KeysetPage([])
+        name, desc = self._get_sort_key()
+        nulls_last = self.facet_set.sort_nulls != NULLS_FIRST
+        backwards = bool(before)
+        if backwards:
+            # walk the same order in reverse and then restore it
+            desc, nulls_last = not desc, not nulls_last
+
+        key_sql, key_params = qs.get_sort_key_sql(name)
+        select = SortedDict()
+        select[SORT_KEY_ALIAS] = key_sql
+        select[SORT_KEY_ISNULL_ALIAS] = '(%s) IS NULL' % key_sql
+        qs = qs.extra(select=select, select_params=key_params + key_params)
+
+        cursor = before or after
+        if cursor:
+            key, pk = decode_cursor(cursor)
+            where, params = self._get_where(qs, key_sql, key_params, key, pk,
+                                            desc, nulls_last)
+            qs = qs.extra(where=[where], params=params)
+
+        direction = '-' if desc else ''
+        qs = qs.order_by('%s%s' % ('' if nulls_last else '-', SORT_KEY_ISNULL_ALIAS),
+                         direction + SORT_KEY_ALIAS, direction + 'pk')
+        items = list(qs[:self.per_page + 1])
+        has_more = len(items) > self.per_page
+        items = items[:self.per_page]
+        if backwards:
+            items.reverse()
+        if not items:
+            return KeysetPage(items)
+
+        first = encode_cursor(getattr(items[0], SORT_KEY_ALIAS), items[0].pk)
+        last = encode_cursor(getattr(items[-1], SORT_KEY_ALIAS), items[-1].pk)
+        if backwards:
+            return KeysetPage(items, next_cursor=last,
+                              previous_cursor=first if has_more else None)
+        return KeysetPage(items, next_cursor=last if has_more else None,
+                          previous_cursor=first if cursor else None)
+
+    def _get_where(self, qs, key_sql, key_params, key, pk, desc, nulls_last):
+        # items that follow (key, pk) in the order: (key IS NULL, key, pk)
+        # with NULL keys placed according to `nulls_last`
+        qn = connection.ops.quote_name
+        pk_sql = '%s.%s' % (qn(qs.model._meta.db_table),
+                            qn(qs.model._meta.pk.column))
+        op = '<' if desc else '>'
+        if key is None:
+            where = '((%s) IS NULL AND %s %s %%s)' % (key_sql, pk_sql, op)
+            params = key_params + [pk]
+            if not nulls_last:
+                where = '(%s OR (%s) IS NOT NULL)' % (where, key_sql)
+                params += key_params
+            return where, params
+        where = '((%s) %s %%s OR ((%s) = %%s AND %s %s %%s))' % (
+            key_sql, op, key_sql, pk_sql, op)
+        params = key_params + [key] + key_params + [key, pk]
+        if nulls_last:
+            where = '(%s OR (%s) IS NULL)' % (where, key_sql)
+            params += key_params
+        return where, params
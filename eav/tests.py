@@ -59,6 +59,58 @@ u'i_can_haz_it'
 >>> Entity.objects.filter(colour='yellow', title='Apple')
 [<Entity: Apple>]
 
+# all attributes of an instance are loaded with a single query on first access
+# and cached; refresh_eav() drops the cache
+
+>>> apple = Entity.objects.get(title='Apple')
+>>> apple.colour
+u'yellow'
+>>> other = Entity.objects.get(title='Apple')
+>>> other.colour = 'red'
+>>> other.save()
+>>> apple.colour
+u'yellow'
+>>> apple.refresh_eav()
+>>> apple.colour
+u'red'
+>>> other.colour = 'yellow'
+>>> other.save()
+
+# the cache is dropped when an attribute is saved via its schema
+
+>>> apple.refresh_eav()
+>>> apple.colour
+u'yellow'
+>>> colour.save_attr(apple, 'blue')
+>>> apple.colour
+u'blue'
+>>> colour.save_attr(apple, 'yellow')
+
+# only changed attributes are saved unless `force_eav` or `eav_fields` is given
+
+>>> apple.refresh_eav()
+>>> apple.colour, apple.taste
+(u'yellow', u'sweet')
+>>> apple.attrs.filter(schema=taste).update(value_text='sour')    # behind our back
+1
+>>> apple.colour = 'red'
+>>> apple.save()
+>>> apple.refresh_eav()
+>>> Entity.objects.get(pk=apple.pk).colour, apple.taste
+(u'red', u'sour')
+>>> apple.colour = 'yellow'
+>>> apple.taste = 'sweet'
+>>> apple.save(eav_fields=['taste'])
+>>> Entity.objects.get(pk=apple.pk).colour, Entity.objects.get(pk=apple.pk).taste
+(u'red', u'sweet')
+>>> apple.save()
+>>> Entity.objects.get(pk=apple.pk).colour
+u'yellow'
+>>> apple.save(eav_fields=['flavour'])
+Traceback (most recent call last):
+...
+NameError: Cannot save Entity: unknown attribute(s) "flavour". Available schemata: (...).
+
 ##
 ## range
 ##
@@ -123,6 +175,31 @@ ValueError: Range must consist of min and max values (min <= max) but got "3" an
 >>> Entity.objects.filter(weight_range__overlaps=(-5, 1))
 [<Entity: Apple>]
 
+# items can also be looked up by ranges they contain or lie within
+
+>>> Entity.objects.filter(weight_range__contains=(2, 3))
+[<Entity: Apple>]
+>>> Entity.objects.filter(weight_range__contains=(0, 2))
+[]
+>>> Entity.objects.filter(weight_range__within=(0, 5))
+[<Entity: Apple>]
+>>> Entity.objects.filter(weight_range__within=(2, None))
+[]
+
+# ranges are indexed by buckets, so lookups only check exact bounds of few
+# candidates
+
+>>> RangeBucket.objects.filter(schema=weight_range).values_list('bucket', flat=True)
+[0]
+>>> e.weight_range = 5, 25
+>>> e.save()
+>>> RangeBucket.objects.filter(schema=weight_range).order_by('bucket').values_list('bucket', flat=True)
+[0, 1, 2]
+>>> Entity.objects.filter(weight_range__overlaps=(21, 22))
+[<Entity: Apple>]
+>>> e.weight_range = 1, 3
+>>> e.save()
+
 
 ##
 ## many-to-one
@@ -157,11 +234,14 @@ ValueError: Range must consist of min and max values (min <= max) but got "3" an
 Traceback (most recent call last):
     ...
 TypeError: Cannot assign "[\'wrong choice\']": "Attr.choice" must be a BaseChoice instance.
+>>> large_attr_pk = Attr.objects.get(schema=size, choice=large).pk
 >>> e2.size = [small, large]
 >>> e2.save()
 >>> e3 = Entity.objects.get(pk=e.pk)
 >>> e3.size
 [<Choice: S>, <Choice: L>]
+>>> Attr.objects.get(schema=size, choice=large).pk == large_attr_pk  # kept intact
+True
 >>> Attr.objects.all().order_by('schema', 'choice__id')
 [<Attr: Apple: Colour "yellow">, <Attr: T-shirt: Size "S">,\
  <Attr: T-shirt: Size "L">, <Attr: Apple: Taste "sweet">,\
@@ -200,6 +280,53 @@ Traceback (most recent call last):
     ...
 TypeError: Cannot assign "[\'wrong choice\']": "Attr.choice" must be a BaseChoice instance.
 
+##
+## schema registry
+##
+
+# schemata and their choices are cached in process memory and invalidated
+# whenever a schema or a choice is saved or deleted
+
+>>> registry = get_schema_registry(Entity)
+>>> registry.get_choices(protein)
+[<Choice: Egg Albumen>, <Choice: Gluten>, <Choice: Lean Meat>]
+>>> flavour = Schema.objects.create(title='Flavour', datatype=Schema.TYPE_TEXT)
+>>> registry.by_name['flavour']
+<Schema: Flavour (text)>
+>>> flavour.delete()
+>>> 'flavour' in registry.by_name
+False
+
+# resolved lookups are cached along with schemata
+
+>>> Entity.objects.filter(colour='orange').count()
+0
+>>> registry.lookup_plans['colour']
+<LookupPlan attr: colour>
+>>> registry.lookup_plans['colour'].value_field == 'value_text'
+True
+>>> Entity.objects.filter(title='Apple').count()
+1
+>>> registry.lookup_plans['title']
+<LookupPlan field: title>
+
+# with a shared cache, changes made by other processes are noticed when the
+# next request starts (or when EAV_SHARED_CACHE_TTL expires)
+
+>>> from django.conf import settings
+>>> from django.core.cache import cache
+>>> from django.core.signals import request_started
+>>> from caching import get_generation
+>>> settings.EAV_SHARED_CACHE = True
+>>> generation = get_generation('schemata')
+>>> shared = cache.incr('eav:generation:schemata')   # bumped elsewhere
+>>> get_generation('schemata') == generation
+True
+>>> responses = request_started.send(sender=None)
+>>> get_generation('schemata') == generation
+False
+>>> settings.EAV_SHARED_CACHE = False
+
 ##
 ## combined
 ##
@@ -216,6 +343,11 @@ TypeError: Cannot assign "[\'wrong choice\']": "Attr.choice" must be a BaseChoic
 >>> Entity.objects.filter(colour='orange', size__in=[small, large])
 [<Entity: Tangerine>, <Entity: Old Dog>]
 
+# each EAV condition is compiled to a subquery, not to a join
+
+>>> 'JOIN' in str(Entity.objects.filter(colour='orange', taste='sweet', size=medium).query)
+False
+
 #
 # exclude() fetches objects that either have given attribute(s) with other values
 # or don't have any attributes for this schema at all:
@@ -230,6 +362,80 @@ TypeError: Cannot assign "[\'wrong choice\']": "Attr.choice" must be a BaseChoic
 >>> Entity.objects.filter(size=large) & Entity.objects.filter(colour='orange')
 [<Entity: Old Dog>]
 
+#
+# prefetch_eav() loads attributes for all fetched entities with a single query
+# and caches them on each instance:
+#
+
+>>> entities = list(Entity.objects.filter(colour='orange').prefetch_eav())
+>>> [(x.title, x.taste, x.size) for x in entities]
+[(u'Orange', u'sweet', [<Choice: M>]), (u'Tangerine', u'sweet', [<Choice: S>]), (u'Old Dog', u'bitter', [<Choice: L>])]
+>>> entities[0]._eav_values_cache['colour']
+u'orange'
+
+#
+# values_eav() returns flat rows with attributes selected as columns:
+#
+
+>>> rows = Entity.objects.filter(colour='orange').values_eav('title', 'taste', 'weight_range')
+>>> [(x['title'], x['taste'], x['weight_range']) for x in rows]
+[(u'Orange', u'sweet', None), (u'Tangerine', u'sweet', None), (u'Old Dog', u'bitter', None)]
+>>> Entity.objects.values_eav('title', 'weight_range').get(title='Apple')['weight_range']
+(1.0, 3.0)
+>>> Entity.objects.values_eav('protein').get(title='Cane')['protein'] == egg_albumen.pk
+True
+>>> Entity.objects.values_eav('size')
+Traceback (most recent call last):
+...
+TypeError: Cannot select attribute "size" as a column: multiple choices are not supported.
+
+#
+# EAV names are resolved at any point of a queryset chain:
+#
+
+>>> Entity.objects.filter(colour='orange').filter(taste='sweet')
+[<Entity: Orange>, <Entity: Tangerine>]
+>>> Entity.objects.all().filter(colour='orange').exclude(size=large)
+[<Entity: Orange>, <Entity: Tangerine>]
+>>> Entity.objects.filter(colour='orange').order_by('-taste', 'title')
+[<Entity: Orange>, <Entity: Tangerine>, <Entity: Old Dog>]
+>>> [(x['title'], x['taste']) for x in Entity.objects.filter(colour='orange').values('title', 'taste')]
+[(u'Orange', u'sweet'), (u'Tangerine', u'sweet'), (u'Old Dog', u'bitter')]
+
+# ...including Q objects combined with OR and NOT; each EAV condition is still
+# a subquery, so the whole tree is queried at once
+
+>>> from django.db.models import Q
+>>> Entity.objects.filter(Q(taste='bitter') | Q(size=small)).order_by('pk')
+[<Entity: T-shirt>, <Entity: Tangerine>, <Entity: Old Dog>]
+>>> Entity.objects.filter(Q(colour='orange') & ~Q(size=small)).order_by('pk')
+[<Entity: Orange>, <Entity: Old Dog>]
+>>> Entity.objects.exclude(Q(colour='orange') | Q(title='Cane')).order_by('pk')
+[<Entity: Apple>, <Entity: T-shirt>]
+>>> 'JOIN' in str(Entity.objects.filter(Q(taste='bitter') | Q(size=small)).query)
+False
+
+# annotations can be filtered by, too
+
+>>> from django.db.models import Count
+>>> Entity.objects.annotate(n=Count('attrs')).filter(n__gt=2, colour='orange').order_by('pk')
+[<Entity: Orange>, <Entity: Tangerine>, <Entity: Old Dog>]
+>>> Entity.objects.annotate(n=Count('attrs')).filter(n__gt=3)
+[]
+
+>>> Entity.objects.order_by('size')
+Traceback (most recent call last):
+...
+TypeError: Cannot order items by attribute "size": multiple choices are not supported.
+
+# several sort keys can be combined; entities that lack the attribute are kept
+# and can be put first or last
+
+>>> Entity.objects.order_by('taste', 'title', nulls=NULLS_LAST)
+[<Entity: Old Dog>, <Entity: Apple>, <Entity: Orange>, <Entity: Tangerine>, <Entity: Cane>, <Entity: T-shirt>]
+>>> Entity.objects.order_by('-taste', 'title', nulls=NULLS_FIRST)
+[<Entity: Cane>, <Entity: T-shirt>, <Entity: Apple>, <Entity: Orange>, <Entity: Tangerine>, <Entity: Old Dog>]
+
 ##
 ## facets
 ##
@@ -256,6 +462,356 @@ TypeError: Cannot assign "[\'wrong choice\']": "Attr.choice" must be a BaseChoic
 >>> [x for x in FacetSet({'size': [large.pk]})]
 [<Entity: T-shirt>, <Entity: Old Dog>]
 
+# facet choices are annotated with numbers of matching items; numbers for all
+# facets are computed with a single query
+
+>>> fs = FacetSet({'colour': 'orange'})
+>>> sorted(fs.counts['taste'].items())
+[(u'bitter', 1), (u'sweet', 2)]
+>>> unicode(dict(fs.form.fields['taste'].choices)[u'sweet'])
+u'sweet (2)'
+>>> 'sweet (2)' in unicode(fs.form['taste'])
+True
+>>> [label for pk, label in fs.form.fields['size'].choices]
+[u'L (1)', u'M (1)', u'S (1)']
+
+# text facets only offer values present in the facet set's base queryset;
+# the lists are cached until attributes change
+
+>>> class OrangeFacetSet(FacetSet):
+...     def get_queryset(self, **kwargs):
+...         return Entity.objects.filter(colour='orange').filter(**kwargs)
+>>> [value for value, label in OrangeFacetSet({}).form.fields['taste'].choices]
+['', u'bitter', u'sweet']
+>>> old_dog = Entity.objects.get(title='Old Dog')
+>>> old_dog.taste = 'salty'
+>>> old_dog.save()
+>>> [value for value, label in OrangeFacetSet({}).form.fields['taste'].choices]
+['', u'salty', u'sweet']
+>>> old_dog.taste = 'bitter'
+>>> old_dog.save()
+
+# non-ASCII params of the base queryset are fine in cache keys
+
+>>> apple_ru = Entity.objects.create(title=u'\\u042f\\u0431\\u043b\\u043e\\u043a\\u043e', taste='sweet')
+>>> class RussianFacetSet(FacetSet):
+...     cache_results = True
+...     def get_queryset(self, **kwargs):
+...         return Entity.objects.filter(title=apple_ru.title).filter(**kwargs)
+>>> fs = RussianFacetSet({})
+>>> [value for value, label in fs.form.fields['taste'].choices], len(fs)
+(['', u'sweet'], 1)
+>>> apple_ru.delete()
+
+# results of a facet set can be cached; equivalent data is normalized to the
+# same key, cached results expire when attributes change
+
+>>> class CachedFacetSet(FacetSet):
+...     cache_results = True
+>>> fs = CachedFacetSet({'colour': 'orange', 'size': [str(large.pk), str(small.pk)]})
+>>> fs.get_normalized_data() == CachedFacetSet({'size': [small.pk, large.pk], 'colour': 'orange'}).get_normalized_data()
+True
+>>> len(CachedFacetSet({'colour': 'orange'}))
+3
+>>> sorted(CachedFacetSet({'colour': 'orange'}).counts['taste'].items())
+[(u'bitter', 1), (u'sweet', 2)]
+>>> Attr.objects.filter(schema=colour, value_text='orange').update(value_text='amber')  # behind our back
+3
+>>> len(CachedFacetSet({'colour': 'orange'}))
+3
+>>> Attr.objects.filter(schema=colour, value_text='amber').update(value_text='orange')
+3
+>>> old_dog.colour = 'brown'
+>>> old_dog.save()
+>>> CachedFacetSet({'colour': 'orange'}).object_list
+[<Entity: Orange>, <Entity: Tangerine>]
+>>> old_dog.colour = 'orange'
+>>> old_dog.save()
+>>> total = len(CachedFacetSet({}))
+>>> stone = Entity.objects.create(title='Stone')    # no attributes
+>>> len(CachedFacetSet({})) == total + 1
+True
+>>> stone.delete()
+>>> len(CachedFacetSet({})) == total
+True
+
+# ids of large result sets are not cached, only their count is
+
+>>> fs = CachedFacetSet({'colour': 'orange'})
+>>> fs.cache_max_ids = 2
+>>> len(fs), fs.object_ids == list(fs.object_list.values_list('pk', flat=True))
+(3, True)
+>>> fs._results['ids'] is None
+True
+
+# range facets provide statistics: bounds and a histogram computed with one
+# query (each item falls into all buckets its value or range overlaps)
+
+>>> for title, value in [('Orange', 2), ('Tangerine', 4), ('Old Dog', 10)]:
+...     e = Entity.objects.get(title=title)
+...     e.age = value
+...     e.save()
+>>> facet = RangeFacet(FacetSet({}), schema=age)
+>>> facet.bucket_count = 2
+>>> facet.stats['min'], facet.stats['max']
+(2.0, 10.0)
+>>> facet.bucket_choices
+[((2.0, 6.0), u'2-6 (2)'), ((6.0, 10.0), u'6-10 (1)')]
+>>> facet = MultiRangeFacet(FacetSet({}), schema=weight_range)
+>>> facet.bucket_count = 2
+>>> facet.bucket_choices
+[((1.0, 2.0), u'1-2 (1)'), ((2.0, 3.0), u'2-3 (1)')]
+
+# sorting by an attribute does not drop items that lack it
+
+>>> Schema.objects.filter(name='taste').update(sortable=True)
+1
+>>> [x.taste for x in FacetSet({'order_by': 'taste'})]
+[u'bitter', u'sweet', u'sweet', u'sweet', None, None]
+>>> 'JOIN' in str(FacetSet({'order_by': 'taste'}).object_list.query)
+False
+
+# facet sets are paginated by keyset, i.e. each page starts after the last
+# item of the previous one instead of skipping rows
+
+>>> paginator = FacetSetPaginator(FacetSet({'order_by': 'taste'}), per_page=4)
+>>> paginator.count
+6
+>>> page = paginator.page()
+>>> [x.title for x in page]
+[u'Old Dog', u'Apple', u'Orange', u'Tangerine']
+>>> page.has_previous(), page.has_next()
+(False, True)
+>>> page = paginator.page(after=page.next_cursor)
+>>> [x.title for x in page]
+[u'T-shirt', u'Cane']
+>>> page.has_previous(), page.has_next()
+(True, False)
+>>> [x.title for x in paginator.page(before=page.previous_cursor)]
+[u'Old Dog', u'Apple', u'Orange', u'Tangerine']
+>>> paginator.page(after='garbage')
+Traceback (most recent call last):
+...
+InvalidCursor: Cannot decode cursor "garbage".
+
+##
+## attribute snapshot
+##
+
+# an entity may store a snapshot of its attributes in a text field; reading
+# attributes of such entity does not hit the attributes table
+
+>>> lemon = CachedEntity.objects.create(title='Lemon', colour='yellow', size=[small, medium])
+>>> lemon = CachedEntity.objects.get(pk=lemon.pk)
+>>> lemon.attrs.all().delete()    # behind our back
+>>> lemon.colour, lemon.size
+(u'yellow', [<Choice: S>, <Choice: M>])
+>>> lemon.refresh_eav()
+>>> lemon.colour, lemon.size
+(None, [])
+>>> lemon.update_eav_snapshot()
+>>> CachedEntity.objects.get(pk=lemon.pk).attrs_snapshot
+u'{}'
+>>> lemon.taste = 'sour'
+>>> lemon.save()
+>>> CachedEntity.objects.get(pk=lemon.pk).taste
+u'sour'
+
+##
+## bulk creation
+##
+
+>>> CachedEntity.objects.bulk_create_with_attrs([
+...     {'title': 'Kiwi', 'colour': 'green', 'size': [small]},
+...     {'title': 'Plum', 'taste': 'sour', 'weight_range': (1, 2)},
+...     {'title': 'Lime', 'colour': 'green', 'taste': 'sour'},
+... ], batch_size=2)
+[<CachedEntity: Kiwi>, <CachedEntity: Plum>, <CachedEntity: Lime>]
+>>> CachedEntity.objects.filter(colour='green', taste='sour')
+[<CachedEntity: Lime>]
+>>> kiwi = CachedEntity.objects.get(title='Kiwi')
+>>> kiwi.colour, kiwi.size
+(u'green', [<Choice: S>])
+>>> fig, = Entity.objects.bulk_create_with_attrs([
+...     {'title': 'Fig', 'colour': u'purple', 'size': [small, large]}])
+>>> fig.colour, fig.size    # no queries, attributes are loaded
+(u'purple', [<Choice: S>, <Choice: L>])
+>>> Entity.objects.get(pk=fig.pk).colour
+u'purple'
+>>> fig.delete()
+>>> CachedEntity.objects.bulk_create_with_attrs([{'title': 'Fig', 'flavour': 'sweet'}])
+Traceback (most recent call last):
+...
+NameError: Cannot create CachedEntity: unknown attribute(s) "flavour". Available fields: (...). Available schemata: (...).
+
+##
+## export
+##
+
+>>> from StringIO import StringIO
+>>> stream = StringIO()
+>>> export_entities(CachedEntity.objects.all(), stream, fields=['title'],
+...                 names=['colour', 'size', 'weight_range'], chunk_size=2)
+4
+>>> for line in stream.getvalue().splitlines():
+...     print line
+title,colour,size,weight_range
+Lemon,,,
+Kiwi,green,S,
+Plum,,,1.0..2.0
+Lime,green,,
+>>> stream = StringIO()
+>>> export_entities(CachedEntity.objects.filter(title='Kiwi'), stream,
+...                 format='jsonl', fields=['title'], names=['colour', 'size'],
+...                 choices='id') == 1
+True
+>>> stream.getvalue() == '{"colour": "green", "size": [%d], "title": "Kiwi"}\\n' % small.pk
+True
+
+##
+## import
+##
+
+>>> feed = StringIO('Name,colour,size,weight_range\\n'
+...                 'Pear,green,S|M,2..3\\n'
+...                 'Grape,purple,XXL,\\n'
+...                 'Melon,yellow,,1..wrong\\n'
+...                 'Quince,yellow,L,\\n')
+>>> rejects = StringIO()
+>>> import_entities(CachedEntity, feed, mapping={'Name': 'title'},
+...                 rejects=rejects, chunk_size=1)
+(2, 2)
+>>> pear = CachedEntity.objects.get(title='Pear')
+>>> pear.colour, pear.size, pear.weight_range
+(u'green', [<Choice: S>, <Choice: M>], (2.0, 3.0))
+>>> CachedEntity.objects.filter(size=large)
+[<CachedEntity: Quince>]
+>>> for line in rejects.getvalue().splitlines():
+...     print line
+Name,_error,colour,size,weight_range
+Grape,"Unknown choice ""XXL"" for attribute ""size"".",purple,XXL,
+Melon,could not convert string to float: wrong,yellow,,1..wrong
+
+# rows refused by the database are rejected, the rest of the chunk is imported
+
+>>> feed = StringIO('{"id": %d, "title": "Pear"}\\n'
+...                 '{"title": "Apricot", "colour": "orange"}\\n'
+...                 '{"title": "%s"}\\n' % (pear.pk, 'x' * 101))
+>>> rejects = StringIO()
+>>> import_entities(CachedEntity, feed, format='jsonl', rejects=rejects)
+(1, 2)
+>>> CachedEntity.objects.get(title='Apricot').colour
+u'orange'
+>>> CachedEntity.objects.filter(title='Pear').count()
+1
+>>> for line in rejects.getvalue().splitlines():
+...     print line    # doctest: +ELLIPSIS
+{"_error": "[u'Ensure this value has at most 100 characters (it has 101).']", "title": "xxx...x"}
+{"_error": "...", "id": ..., "title": "Pear"}
+
+# malformed rows are rejected, too
+
+>>> feed = StringIO('title,colour\\n'
+...                 'Cherry\\n')
+>>> import_entities(CachedEntity, feed)
+(1, 0)
+>>> CachedEntity.objects.get(title='Cherry').colour is None
+True
+>>> feed = StringIO('{"title": "Date"}\\n'
+...                 '{"title": \\n'
+...                 '["Fig"]\\n')
+>>> rejects = StringIO()
+>>> import_entities(CachedEntity, feed, format='jsonl', rejects=rejects)
+(1, 2)
+>>> for line in rejects.getvalue().splitlines():
+...     print line
+{"_error": "No JSON object could be decoded", "_line": "{\\"title\\": "}
+{"_error": "Expected a JSON object, got \\"[\\"Fig\\"]\\".", "_line": "[\\"Fig\\"]"}
+
+##
+## narrow attribute tables
+##
+
+>>> [TypedEntity.get_attr_model(x).__name__ for x in (colour, age, size, weight_range)]
+['TextAttr', 'FloatAttr', 'ChoiceAttr', 'Attr']
+>>> box = TypedEntity.objects.create(title='Box', colour='red', age=3, size=[small],
+...                                  weight_range=(1, 5))
+>>> TextAttr.objects.count(), FloatAttr.objects.count(), ChoiceAttr.objects.count()
+(1, 1, 1)
+>>> box.attrs.count()
+1
+>>> TypedEntity.objects.filter(colour='red', age__gt=2, size=small,
+...                            weight_range__contains=(2, 3))
+[<TypedEntity: Box>]
+>>> box = TypedEntity.objects.get(pk=box.pk)
+>>> box.colour, box.age, box.size, box.weight_range
+(u'red', 3.0, [<Choice: S>], (1.0, 5.0))
+>>> box.colour = 'blue'
+>>> box.save()
+>>> TypedEntity.objects.filter(colour='red')
+[]
+>>> TextAttr.objects.get().value
+u'blue'
+>>> box.delete()
+>>> TextAttr.objects.count(), FloatAttr.objects.count(), ChoiceAttr.objects.count()
+(0, 0, 0)
+>>> Attr.objects.filter(entity_type__model='typedentity').count()
+0
+
+##
+## attributes with a foreign key to entity
+##
+
+>>> LinkedEntity.get_attr_model().__name__
+'LinkedAttr'
+>>> shelf = LinkedEntity.objects.create(title='Shelf', colour='oak', age=7,
+...                                     size=[small, large])
+>>> shelf.attrs.count()
+4
+>>> LinkedEntity.objects.filter(colour='oak', size=large, age__lt=10)
+[<LinkedEntity: Shelf>]
+>>> shelf = LinkedEntity.objects.get(pk=shelf.pk)
+>>> shelf.colour, shelf.size
+(u'oak', [<Choice: S>, <Choice: L>])
+>>> [(x['title'], x['age']) for x in LinkedEntity.objects.values_eav('title', 'age')]
+[(u'Shelf', 7.0)]
+>>> shelf.delete()
+>>> LinkedAttr.objects.count()
+0
+
+##
+## index check
+##
+
+# composite indexes declared on attribute models are found in the database
+
+>>> from django.db import connection
+>>> from management.commands.eav_check_indexes import (get_expected_indexes,
+...                                                    get_missing_indexes)
+>>> cursor = connection.cursor()
+>>> ('schema_id', 'value_float', 'entity_id') in get_expected_indexes(LinkedAttr)
+True
+>>> [get_missing_indexes(cursor, x) for x in (Attr, TextAttr, LinkedAttr, RangeBucket)]
+[[], [], [], []]
+>>> get_missing_indexes(cursor, Entity)
+[]
+
+# management commands write to given streams
+
+>>> from django.core.management import call_command
+>>> out, err = StringIO(), StringIO()
+>>> call_command('eav_check_indexes', 'eav.Attr', stdout=out, stderr=err)
+>>> out.getvalue(), err.getvalue()
+('', '0 missing index(es) found.\\n')
+>>> out, err = StringIO(), StringIO()
+>>> call_command('eav_export', 'eav.CachedEntity', format='jsonl',
+...              fields='title', names='colour', stdout=out, stderr=err)
+>>> print out.getvalue()    # doctest: +ELLIPSIS
+{"colour": null, "title": "Lemon"}
+...
+>>> err.getvalue()    # doctest: +ELLIPSIS
+'Exported ... entities.\\n'
+
 Entities used in the tests
 --------------------------
 """
@@ -267,8 +823,15 @@ from django.contrib.contenttypes import generic
 from django.db import models
 
 # this app
-from facets import BaseFacetSet
-from models import BaseAttribute, BaseChoice, BaseEntity, BaseSchema
+from caching import get_schema_registry
+from exporters import export_entities
+from facets import BaseFacetSet, MultiRangeFacet, RangeFacet
+from importers import import_entities
+from managers import NULLS_FIRST, NULLS_LAST
+from models import (BaseAttribute, BaseChoice, BaseChoiceAttribute, BaseEntity,
+                    BaseEntityAttribute, BaseFloatAttribute, BaseRangeBucket,
+                    BaseSchema, BaseTextAttribute)
+from pagination import FacetSetPaginator
 
 
 class Schema(BaseSchema):
@@ -285,6 +848,11 @@ class Attr(BaseAttribute):
     choice = models.ForeignKey(Choice, related_name='attrs', null=True)
 
 
+class RangeBucket(BaseRangeBucket):
+    attr = models.ForeignKey(Attr, related_name='range_buckets')
+    schema = models.ForeignKey(Schema)
+
+
 class Entity(BaseEntity):
     title = models.CharField(max_length=100)
     price = models.IntegerField(blank=True, null=True, verbose_name='Item price')
@@ -299,6 +867,73 @@ class Entity(BaseEntity):
         return self.title
 
 
+class CachedEntity(BaseEntity):
+    title = models.CharField(max_length=100)
+    attrs = generic.GenericRelation(Attr, object_id_field='entity_id',
+                                    content_type_field='entity_type')
+    attrs_snapshot = models.TextField(blank=True, editable=False)
+
+    eav_snapshot_field = 'attrs_snapshot'
+
+    @classmethod
+    def get_schemata_for_model(cls):
+        return Schema.objects.all()
+
+    def __unicode__(self):
+        return self.title
+
+
+class TextAttr(BaseTextAttribute):
+    schema = models.ForeignKey(Schema, related_name='text_attrs')
+
+
+class FloatAttr(BaseFloatAttribute):
+    schema = models.ForeignKey(Schema, related_name='float_attrs')
+
+
+class ChoiceAttr(BaseChoiceAttribute):
+    schema = models.ForeignKey(Schema, related_name='choice_attrs')
+    choice = models.ForeignKey(Choice, related_name='choice_attrs', null=True)
+
+
+class TypedEntity(BaseEntity):
+    title = models.CharField(max_length=100)
+    # values of other datatypes are stored in the generic table
+    attrs = generic.GenericRelation(Attr, object_id_field='entity_id',
+                                    content_type_field='entity_type')
+
+    eav_attr_models = {
+        Schema.TYPE_TEXT: TextAttr,
+        Schema.TYPE_FLOAT: FloatAttr,
+        Schema.TYPE_ONE: ChoiceAttr,
+        Schema.TYPE_MANY: ChoiceAttr,
+    }
+
+    @classmethod
+    def get_schemata_for_model(cls):
+        return Schema.objects.all()
+
+    def __unicode__(self):
+        return self.title
+
+
+class LinkedEntity(BaseEntity):
+    title = models.CharField(max_length=100)
+
+    @classmethod
+    def get_schemata_for_model(cls):
+        return Schema.objects.all()
+
+    def __unicode__(self):
+        return self.title
+
+
+class LinkedAttr(BaseEntityAttribute):
+    entity = models.ForeignKey(LinkedEntity, related_name='attrs')
+    schema = models.ForeignKey(Schema, related_name='linked_attrs')
+    choice = models.ForeignKey(Choice, related_name='linked_attrs', null=True)
+
+
 class FacetSet(BaseFacetSet):
     filterable_fields = ['price']
     sortable_fields = ['price']
@@ -37,7 +37,7 @@ setup(
 
     # technical info
     version  = eav.__version__,
-    packages = ['eav'],
+    packages = ['eav', 'eav.management', 'eav.management.commands'],
     requires = ['python (>= 2.5)', 'django (>= 1.1)',
                 'django_autoslug (>= 1.3.9)',
                 'django_view_shortcuts (>= 1.3.5)'],